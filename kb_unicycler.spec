@@ -29,11 +29,55 @@ module kb_unicycler {
     short_paired_libraries - a list of short, paired end reads libraries
     short_unpaired_libraries - a list of short, paired end reads libraries
     long_reads_library - a long reads library
+    threads - the number of threads for Unicycler and the tools it runs;
+              by default, all cpus available to the job are used
+    download_threads - the maximum number of reads libraries to download
+                       at the same time (default 4)
+    direct_reads_input - if 1 (the default), a single short reads library is
+                         passed to Unicycler as downloaded instead of being
+                         copied into a combined file, and several libraries
+                         that are all gzipped are combined into one gzip file
+                         without decompressing them
+    compress_combined_reads - if 1 (the default), reads combined from several
+                              libraries are written gzipped; gzipped input
+                              files are appended without recompression
+    long_read_target_bases - if set, the long reads are subsampled to at most
+                             this many bases, keeping the reads with the most
+                             expected correct bases (length times mean base
+                             accuracy)
+    target_depth - if set, the short paired end reads are digitally normalized
+                   before assembly: a read pair is dropped if the median count
+                   of its k-mers in the pairs kept so far is already
+                   target_depth (1 to 254)
+    max_depth - if set, the short and the long reads are each downsampled to
+                this depth if they are deeper, based on a k-mer spectrum
+                estimate of the genome size; short reads are sampled at
+                random, long reads keep the best ones
+    quast_mode - how the assembly metrics in the report are made: 'full' runs
+                 QUAST (default), 'builtin' computes the metrics without
+                 running QUAST
+    zip_compresslevel - compression level of the zip file of the output, 1
+                        (fastest) to 9 (smallest), or 0 to store the files
+                        uncompressed; default 6
+    output_tier - which of unicycler's output files are packaged in the
+                  report's zip file: 'final' the assembly, its graph and the
+                  log, 'standard' all but the intermediate assembly graphs,
+                  'full' all of them (default)
 
     @optional min_contig_length
     @optional num_linear_seqs
     @optional bridging_mode
     @optional no_correct
+    @optional threads
+    @optional download_threads
+    @optional direct_reads_input
+    @optional compress_combined_reads
+    @optional long_read_target_bases
+    @optional target_depth
+    @optional max_depth
+    @optional quast_mode
+    @optional zip_compresslevel
+    @optional output_tier
     */
 
     typedef structure {
@@ -48,6 +92,16 @@ module kb_unicycler {
         int min_long_read_length;
         int num_linear_seqs;
         string bridging_mode;
+        int threads;
+        int download_threads;
+        int direct_reads_input;
+        int compress_combined_reads;
+        int long_read_target_bases;
+        int target_depth;
+        int max_depth;
+        string quast_mode;
+        int zip_compresslevel;
+        string output_tier;
     } UnicyclerParams;
 
     /* Output parameters for Unicycler run.
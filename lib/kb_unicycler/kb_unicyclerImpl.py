@@ -12,11 +12,17 @@ import numpy as np
 import yaml
 import time
 import zipfile
+import zlib
+import gzip
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
 from pprint import pformat
 import sys
 from html import escape
-from shutil import copy, copytree, move
+from shutil import copy, copytree, move, copyfileobj
 
 from installed_clients.WorkspaceClient import Workspace
 from installed_clients.ReadsUtilsClient import ReadsUtils  # @IgnorePep8
@@ -26,6 +32,278 @@ from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.kb_quastClient import kb_quast
 from SetAPI.SetAPIServiceClient import SetAPI
+
+try:
+    # ISA-L gzip, decompressing in a background thread; much faster than zlib
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+
+def deflate_zip_member(path, output_path, level, chunk_size):
+    """
+    Deflate a file into output_path as the raw deflate stream a zip member
+    holds, reading it chunk_size bytes at a time; run in a worker process.
+    Returns the crc, size and compressed size for the member's header.
+    """
+    deflater = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    file_size = 0
+    with open(path, 'rb') as in_file, open(output_path, 'wb') as out_file:
+        while True:
+            chunk = in_file.read(chunk_size)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            out_file.write(deflater.compress(chunk))
+        out_file.write(deflater.flush())
+        compress_size = out_file.tell()
+    return [crc, file_size, compress_size]
+
+
+class ConsoleLog:
+    """
+    Console log sink: every message is written to a file at path, and only
+    the last tail_lines are kept in memory, for error messages. Iterating
+    over it reads the messages back from the file, one line at a time.
+    """
+
+    def __init__(self, path, tail_lines=1000):
+        self.path = path
+        self.tail = deque(maxlen=tail_lines)
+        self.n_lines = 0
+        self.lock = threading.Lock()
+        self.log_file = open(path, 'w', encoding='utf-8', errors='replace')
+
+    def append(self, message):
+        lines = str(message).split('\n')
+        with self.lock:
+            self.log_file.write('\n'.join(lines) + '\n')
+            self.tail.extend(lines)
+            self.n_lines += len(lines)
+
+    def __len__(self):
+        return self.n_lines
+
+    def __iter__(self):
+        with self.lock:
+            self.log_file.flush()
+        with open(self.path, encoding='utf-8', errors='replace') as log_file:
+            for line in log_file:
+                yield line.rstrip('\n')
+
+    # the last n lines, from memory
+    def last(self, n):
+        return list(self.tail)[-n:]
+
+    def close(self):
+        with self.lock:
+            self.log_file.close()
+
+
+class StageTimer:
+    """
+    Times unicycler's stages, from the section headers in its output: when
+    each starts and ends, and the peak memory (RSS) of its process tree
+    during it, from the samples given to add_rss. stage_keywords maps words
+    in a header to a stage; headers without one are stages of their own,
+    and end_header ends the last stage.
+    """
+
+    HEADER_PATTERN = re.compile(
+        r'^(?:\x1b\[[0-9;]*m)*(.*?\S)(?:\x1b\[[0-9;]*m)* '
+        r'(?:\x1b\[[0-9;]*m)*\((\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\)(?:\x1b\[[0-9;]*m)*$')
+
+    def __init__(self, stage_keywords, end_header):
+        self.stage_keywords = stage_keywords
+        self.end_header = end_header
+        self.stages = []
+        self.lock = threading.Lock()
+
+    # end the last stage
+    def stop(self):
+        with self.lock:
+            self.end_stage()
+
+    def end_stage(self):
+        if self.stages and self.stages[-1]['end'] is None:
+            self.stages[-1]['end'] = time.time()
+            self.stages[-1]['seconds'] = round(self.stages[-1]['end'] -
+                                               self.stages[-1]['start'], 1)
+
+    # look at a line of output; a section header starts a new stage, unless
+    # it is part of the one already running
+    def line(self, text):
+        header = self.HEADER_PATTERN.match(text)
+        if header is None:
+            return
+        header = header.group(1)
+        stage = header
+        for keyword, keyword_stage in self.stage_keywords:
+            if keyword in header.lower():
+                stage = keyword_stage
+                break
+        with self.lock:
+            if self.stages and self.stages[-1]['end'] is None and \
+                    self.stages[-1]['stage'] == stage:
+                return
+            self.end_stage()
+            if not header.startswith(self.end_header):
+                self.stages.append({'stage': stage, 'start': time.time(), 'end': None,
+                                    'seconds': None, 'peak_rss': 0})
+
+    def add_rss(self, rss):
+        with self.lock:
+            if self.stages and self.stages[-1]['end'] is None:
+                self.stages[-1]['peak_rss'] = max(self.stages[-1]['peak_rss'], rss)
+
+    def write_json(self, path):
+        with self.lock:
+            with open(path, 'w') as json_file:
+                json.dump(self.stages, json_file, indent=1)
+
+
+class ProcessSampler:
+    """
+    Samples the process tree under pid every interval seconds on its own
+    thread: cpu %, RSS, bytes read and written and threads, summed over the
+    processes of each executable, are written to path as tab separated
+    lines of seconds since the start, executable, number of processes, cpu
+    %, RSS, read bytes, write bytes, threads. The total RSS of each sample
+    is passed to on_sample, if given.
+    """
+
+    COLUMNS = ['seconds', 'executable', 'processes', 'cpu_percent', 'rss', 'read_bytes',
+               'write_bytes', 'threads']
+
+    def __init__(self, pid, path, interval=5, on_sample=None):
+        self.pid = pid
+        self.path = path
+        self.interval = interval
+        self.on_sample = on_sample
+        # psutil needs the same Process object each time to measure cpu %
+        self.processes = dict()
+        self.peaks = dict()
+        self.done = threading.Event()
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.start_time = time.time()
+        self.sampler.start()
+
+    def stop(self):
+        self.done.set()
+        self.sampler.join()
+
+    # the name a process is reported under: java runs pilon
+    def executable(self, process):
+        name = process.name()
+        if name == 'java' and any('pilon' in arg.lower() for arg in process.cmdline()):
+            return 'pilon'
+        return name
+
+    def sample(self):
+        try:
+            root = psutil.Process(self.pid)
+            tree = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return dict()
+        usage = dict()
+        processes = dict()
+        for process in tree:
+            process = self.processes.get(process.pid, process)
+            try:
+                with process.oneshot():
+                    name = self.executable(process)
+                    values = [1, process.cpu_percent(None), process.memory_info().rss, 0, 0,
+                              process.num_threads()]
+                    try:
+                        io = process.io_counters()
+                        values[3:5] = [io.read_bytes, io.write_bytes]
+                    except (psutil.Error, AttributeError):
+                        pass
+            except psutil.Error:
+                continue
+            processes[process.pid] = process
+            usage[name] = [a + b for a, b in zip(usage.get(name, [0] * 6), values)]
+        self.processes = processes
+        return usage
+
+    def run(self):
+        with open(self.path, 'w') as usage_file:
+            usage_file.write('\t'.join(self.COLUMNS) + '\n')
+            while not self.done.wait(self.interval):
+                usage = self.sample()
+                seconds = int(time.time() - self.start_time)
+                for name, values in sorted(usage.items()):
+                    usage_file.write('\t'.join([str(seconds), name] +
+                                               [str(int(v)) for v in values]) + '\n')
+                    peak = self.peaks.setdefault(name, [0] * 6)
+                    self.peaks[name] = [max(a, b) for a, b in zip(peak, values)]
+                usage_file.flush()
+                if self.on_sample is not None and usage:
+                    self.on_sample(sum(values[2] for values in usage.values()))
+
+    # the peak of each value for each executable, largest peak RSS first
+    def summary(self):
+        return [dict(zip(['executable'] + self.COLUMNS[2:], [name] + [int(v) for v in peak]))
+                for name, peak in sorted(self.peaks.items(), key=lambda item: -item[1][2])]
+
+
+class ContigTable:
+    """
+    Per-contig assembly stats held as numpy columns: length, depth, circular,
+    gc (number of G and C) and n (number of N), alongside the contig ids.
+    """
+
+    def __init__(self, contig_ids, length, depth, circular, gc, n):
+        self.contig_ids = list(contig_ids)
+        self.length = np.asarray(length, dtype=np.int64)
+        self.depth = np.asarray(depth, dtype=np.float64)
+        self.circular = np.asarray(circular, dtype=bool)
+        self.gc = np.asarray(gc, dtype=np.int64)
+        self.n = np.asarray(n, dtype=np.int64)
+        self.sorted_length = np.sort(self.length)[::-1]
+
+    def __len__(self):
+        return len(self.contig_ids)
+
+    def total_length(self):
+        return int(self.length.sum())
+
+    def mean_length(self):
+        return self.total_length() / float(len(self))
+
+    # Nx and Lx: the length of the contig at which the contigs, longest
+    # first, add up to fraction of the total length, and the number of
+    # contigs up to there.  With genome_size, NGx and LGx instead, which are
+    # 0 if the contigs don't add up to that much.
+    def nx(self, fraction, genome_size=None):
+        target = fraction * (genome_size if genome_size else self.total_length())
+        i = int(np.searchsorted(np.cumsum(self.sorted_length), target))
+        if i >= len(self.sorted_length):
+            return [0, 0]
+        return [int(self.sorted_length[i]), i + 1]
+
+    # area under the Nx curve: the length-weighted mean contig length
+    def aun(self):
+        return float((self.length.astype(np.float64) ** 2).sum() / max(self.total_length(), 1))
+
+    # GC percentage of each contig, not counting Ns
+    def contig_gc(self):
+        return 100.0 * self.gc / np.maximum(self.length - self.n, 1)
+
+    # GC percentage of the whole assembly, not counting Ns; weighting each
+    # contig by its depth gives the GC content of the reads that assembled
+    def gc_content(self, depth_weighted=False):
+        weights = self.depth if depth_weighted else np.ones(len(self))
+        return float(100.0 * (self.gc * weights).sum() /
+                     max(((self.length - self.n) * weights).sum(), 1))
+
+    # number of contigs in each length bucket, and the bucket edges
+    def length_histogram(self, bins=10):
+        return np.histogram(self.length, bins)
 #END_HEADER
 
 
@@ -50,62 +328,323 @@ A wrapper for the unicycler assembler
     GIT_COMMIT_HASH = "4fcf8960ce76ed3efa4bb75ddf689a0c78ca06d9"
 
     #BEGIN_CLASS_HEADER
-    def log(self, target, message):
+    # memory planning heuristics
+    GZIP_FASTQ_RATIO = 4.0
+    FASTQ_BASES_PER_BYTE = 0.45
+    SPADES_BASE_GB = 4.0
+    SPADES_GB_PER_GBASE = 4.0
+    SPADES_MEMORY_FRACTION = 0.9
+    PILON_BASE_GB = 4.0
+    PILON_GB_PER_GBASE = 2.0
+    PILON_MEMORY_FRACTION = 0.8
+    # the heap pilon had before it was planned; kept as a floor, when there is
+    # room for it, until the estimate of its need has been measured
+    PILON_MIN_GB = 16
+    DEFAULT_DOWNLOAD_THREADS = 4
+    COPY_BUFFER_SIZE = 16 * 1024 * 1024
+    COMBINED_READS_COMPRESSLEVEL = 1
+    SCAN_CHUNK_SIZE = 4 * 1024 * 1024
+    MAX_LONG_READ_BASES = 1000000000
+    # digital normalization: k-mer size, count-min sketch shape (uint8
+    # counters, so rows * width bytes) and read pairs per batch
+    NORMALIZE_KMER_SIZE = 20
+    NORMALIZE_SKETCH_ROWS = 4
+    NORMALIZE_SKETCH_BITS = 25
+    NORMALIZE_BATCH_PAIRS = 10000
+    # odd multipliers for multiply-shift hashing, one per sketch row
+    NORMALIZE_HASH_MULTIPLIERS = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f,
+                                  0x165667b19e3779f9, 0xd6e8feb86659fd93)
+    # coverage estimation: k-mer size, how many bases of reads to take
+    # k-mers from, and 1 in 2 ** ESTIMATE_KMER_SAMPLE_BITS k-mers sampled
+    ESTIMATE_KMER_SIZE = 21
+    ESTIMATE_SAMPLE_BASES = 200000000
+    ESTIMATE_KMER_SAMPLE_BITS = 5
+    # bases of reads read at least to extrapolate the size of a file from
+    ESTIMATE_MIN_SCAN_BASES = 100000000
+    # a header as unicycler writes it, or any other line
+    CONTIG_HEADER_PATTERN = re.compile(
+        r'^[ \t\r\f\v]*([^\s>]+) length=\d+ depth=(\d+(?:\.\d*)?)x( circular=true)?[ \t\r\f\v]*$'
+        r'|^(.*)$', re.M)
+    # console messages kept in memory, and how many of the last ones are
+    # given with an error from unicycler
+    CONSOLE_TAIL_LINES = 1000
+    ERROR_CONTEXT_LINES = 50
+    # unicycler's stages, by a word in the section headers that start them
+    # (headers are matched in lower case, first keyword first), and the
+    # header that ends the last one
+    STAGE_KEYWORDS = [('error correction', 'read correction'),
+                      ('k-mer range', 'spades assembly'),
+                      ('spades', 'spades assembly'),
+                      ('multiplicity', 'graph cleaning'),
+                      ('cleaning', 'graph cleaning'),
+                      ('miniasm', 'long read assembly'),
+                      ('racon', 'racon polishing'),
+                      ('pilon', 'pilon polishing'),
+                      ('bridg', 'bridging'),
+                      ('long read', 'bridging'),
+                      ('rotating', 'rotation')]
+    STAGE_END_HEADER = 'Assembly complete'
+    # seconds between samples of the resources used by unicycler's processes
+    RESOURCE_SAMPLE_INTERVAL = 5
+    # reading the output of unicycler: bytes per read, a progress counter
+    # line, and seconds between progress frames printed while they arrive
+    OUTPUT_READ_SIZE = 64 * 1024
+    PROGRESS_COUNTER_PATTERN = re.compile(r'^\s*(\d+) / (\d+)\b')
+    PROGRESS_INTERVAL = 10
+    # output files smaller than this are deflated in-process, larger ones in
+    # a process pool; files with these suffixes are already compressed and
+    # are stored as they are
+    ZIP_POOL_MIN_SIZE = 1024 * 1024
+    ZIP_STORED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zip', '.bam', '.png', '.jpg')
+    # which output files are packaged: 'final' is only FINAL_OUTPUT_FILES,
+    # 'standard' all but the intermediate graphs unicycler numbers in the
+    # order it makes them (001_best_spades_graph.gfa, ...), 'full' all
+    OUTPUT_TIERS = ['final', 'standard', 'full']
+    FINAL_OUTPUT_FILES = ['assembly.fasta', 'assembly.gfa', 'unicycler.log']
+    INTERMEDIATE_GRAPH_PATTERN = re.compile(r'^\d+_.*\.gfa$')
+    # full: kb_quast as before, builtin: metrics computed here, without the
+    # kb_quast call
+    QUAST_MODES = ['full', 'builtin']
+    # contig lengths the builtin metrics give counts and totals for
+    METRICS_LENGTH_THRESHOLDS = [0, 1000, 5000, 10000, 25000, 50000]
+    # predicted runtime class by Gbases of input, smallest first
+    RUNTIME_CLASSES = [(0.5, 'short (under an hour)'),
+                       (2.0, 'medium (a few hours)'),
+                       (float('inf'), 'long (many hours)')]
+
+    def log(self, target, message, flush=True):
         if target is not None:
             target.append(message)
         print(message)
-        sys.stdout.flush()
-
-    # from kb_SPAdes/utils/spades_utils.py:
-    def load_stats(self, console, input_file_name):
-        self.log(console, 'Starting conversion of FASTA to KBaseGenomeAnnotations.Assembly')
-        # self.log(console, 'Building Object.')
-        if not os.path.isfile(input_file_name):
-            raise Exception('The input file name {0} is not a file!'.format(input_file_name))
-        with open(input_file_name, 'r') as input_file_handle:
-            contig_id = None
-            sequence_len = 0
-            length_dict = dict()
-            coverage_dict = dict()
-            circ_dict = dict()
-            first_header_found = False
-            # Pattern for replacing white space
-            pattern = re.compile(r'\s+')
-            for current_line in input_file_handle:
-                if (current_line[0] == '>'):
-                    # found a header line
-                    # Wrap up previous fasta sequence
-                    if not first_header_found:
-                        first_header_found = True
-                    else:
-                        length_dict[contig_id] = sequence_len
-                        sequence_len = 0
-                    fasta_header = current_line.replace('>', '').strip()
-                    # self.log(console, 'fasta header = '+fasta_header)
-                    try:
-                        fields = fasta_header.strip().split(' ')
-                        contig_id = fields[0]
-                        # don't trust length from header, we look at seqence:
-                        # sequence_len = int(fields[1][7:]) if (fields[1].startswith('length=')) else 0
-                        coverage = float(
-                            fields[2][6:-1]) if (fields[2].startswith('depth=')) else 0.0
-                        circ = 'Y' if ((len(fields) > 3) and (
-                            'circular=true' in fields[3])) else 'N'
-                        # length_dict[contig_id] = sequence_len
-                        coverage_dict[contig_id] = coverage
-                        circ_dict[contig_id] = circ
-                    except (IndexError, ValueError, KeyError):
-                        contig_id = fasta_header.strip()
-                        coverage_dict[contig_id] = 0
-                        circ_dict[contig_id] = 'N'
-                else:
-                    sequence_len += len(re.sub(pattern, '', current_line))
-        # wrap up last fasta sequence
-        if not first_header_found:
-            raise Exception("There are no contigs in this file")
+        if flush:
+            sys.stdout.flush()
+
+    # log the output of a process as it arrives, a chunk at a time, passing
+    # each line to stage_timer if there is one.
+    # Progress bars, drawn as frames separated by carriage returns or as runs
+    # of 'N / M' counter lines, are collapsed to their last frame; a frame is
+    # printed (but not logged) every PROGRESS_INTERVAL seconds meanwhile.
+    # tput's complaints about there being no terminal are dropped.
+    def log_process_output(self, console, stream, stage_timer=None):
+        progress = None
+        progress_count = None
+        after_cr = False
+        shown = time.time()
+        pending = b''
+        while True:
+            chunk = stream.read1(self.OUTPUT_READ_SIZE)
+            if chunk:
+                data = pending + chunk
+                # a carriage return at the end may be the start of a newline
+                cut = len(data) - 1 if data.endswith(b'\r') else len(data)
+                pieces = re.split(b'(\r\n|\r|\n)', data[:cut])
+                pending = pieces.pop() + data[cut:]
+            else:
+                pieces = [pending, b'\n'] if pending else []
+            for i in range(0, len(pieces), 2):
+                line = pieces[i].decode('utf-8', 'replace').rstrip()
+                # whatever follows a carriage return is a frame of the same bar
+                frame = after_cr or pieces[i + 1] == b'\r'
+                after_cr = pieces[i + 1] == b'\r'
+                counter = self.PROGRESS_COUNTER_PATTERN.match(line)
+                if frame or counter:
+                    count = [int(counter.group(1)), int(counter.group(2))] if counter else None
+                    if (count is not None and progress_count is not None and
+                            (count[1] != progress_count[1] or count[0] < progress_count[0])):
+                        # a new counter; keep the last frame of the one before
+                        self.log(console, progress, False)
+                    if line.strip():
+                        progress = line
+                        progress_count = count
+                    if frame and not after_cr and progress is not None:
+                        # the last frame, ended by a newline
+                        self.log(console, progress, False)
+                        progress = None
+                        progress_count = None
+                    elif time.time() - shown > self.PROGRESS_INTERVAL and progress is not None:
+                        print(progress)
+                        shown = time.time()
+                    continue
+                if progress is not None:
+                    self.log(console, progress, False)
+                    progress = None
+                    progress_count = None
+                if not line.startswith('tput'):
+                    self.log(console, line, False)
+                    if stage_timer is not None:
+                        stage_timer.line(line)
+            sys.stdout.flush()
+            if not chunk:
+                break
+        if progress is not None:
+            self.log(console, progress)
+
+    # count the cpus this job may actually use: the cgroup quota and the cpu
+    # affinity mask can both be smaller than the number of cores on the node
+    def detect_cpus(self):
+        cpus = psutil.cpu_count() or 1
+        try:
+            cpus = min(cpus, len(os.sched_getaffinity(0)))
+        except (AttributeError, OSError):
+            pass
+        quota = None
+        try:
+            # cgroup v2
+            with open('/sys/fs/cgroup/cpu.max') as f:
+                fields = f.read().split()
+            if fields[0] != 'max':
+                quota = float(fields[0]) / float(fields[1])
+        except (OSError, IndexError, ValueError):
+            try:
+                # cgroup v1
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                    quota_us = int(f.read())
+                with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                    period_us = int(f.read())
+                if quota_us > 0 and period_us > 0:
+                    quota = float(quota_us) / period_us
+            except (OSError, ValueError):
+                pass
+        if quota is not None:
+            cpus = min(cpus, max(1, int(quota)))
+        return cpus
+
+    # choose the number of threads for unicycler and the tools it runs
+    # (SPAdes, Racon, Pilon, BLAST, bowtie2)
+    def plan_threads(self, console, params):
+        available = self.detect_cpus()
+        requested = params.get('threads')
+        if requested is not None and int(requested) > 0:
+            threads = int(requested)
+            if threads > available:
+                self.log(console, 'Warning: '+str(threads)+' threads requested, but only ' +
+                         str(available)+' cpus are available to this job')
         else:
-            length_dict[contig_id] = sequence_len
-        return [length_dict, coverage_dict, circ_dict]
+            threads = available
+        self.log(console, 'Using '+str(threads)+' threads ('+str(available) +
+                 ' cpus available)')
+        return threads
+
+    # memory this job may use, in bytes: the smaller of what the node has
+    # available and the cgroup memory limit
+    def detect_memory(self):
+        memory = psutil.virtual_memory().available
+        for limit_file in ['/sys/fs/cgroup/memory.max',                     # cgroup v2
+                           '/sys/fs/cgroup/memory/memory.limit_in_bytes']:  # cgroup v1
+            try:
+                with open(limit_file) as f:
+                    limit = f.read().strip()
+            except OSError:
+                continue
+            if limit.isdigit():
+                memory = min(memory, int(limit))
+            break
+        return memory
+
+    # rough number of bases in a reads file, from its size on disk
+    def estimate_bases(self, path):
+        size = os.path.getsize(path)
+        if path.endswith('.gz'):
+            size *= self.GZIP_FASTQ_RATIO
+        if re.search(r'\.(fa|fasta|fna)(\.gz)?$', path):
+            return int(size)
+        # fastq: about half of the bytes are quality scores
+        return int(size * self.FASTQ_BASES_PER_BYTE)
+
+    # size the SPAdes memory limit and the Pilon java heap from the memory
+    # available to the job and the amount of input
+    def plan_memory(self, console, input_paths):
+        gb = 1024 ** 3
+        budget_gb = self.detect_memory() / gb
+        input_gbases = sum([self.estimate_bases(p) for p in input_paths]) / 1e9
+        spades_need_gb = self.SPADES_BASE_GB + self.SPADES_GB_PER_GBASE * input_gbases
+        pilon_need_gb = self.PILON_BASE_GB + self.PILON_GB_PER_GBASE * input_gbases
+
+        # SPAdes only treats -m as a ceiling, so let it have everything but
+        # some headroom; the pilon heap is what it should need, but no less
+        # than PILON_MIN_GB, and no more than its share of the budget
+        spades_gb = max(1, int(budget_gb * self.SPADES_MEMORY_FRACTION))
+        pilon_gb = max(1, int(min(budget_gb * self.PILON_MEMORY_FRACTION,
+                                  max(self.PILON_MIN_GB, pilon_need_gb))))
+
+        self.log(console, 'Memory plan: {:.1f} GB available, ~{:.2f} Gbases of input; '
+                 'SPAdes limit {} GB (estimated need {:.1f} GB), Pilon heap {} GB '
+                 '(estimated need {:.1f} GB)'.format(budget_gb, input_gbases, spades_gb,
+                                                     spades_need_gb, pilon_gb, pilon_need_gb))
+        if spades_need_gb > spades_gb:
+            self.log(console, 'Warning: SPAdes may need more memory than is available to this job')
+        return {'spades_gb': spades_gb, 'pilon_gb': pilon_gb}
+
+    # scan a fasta file in large binary blocks of complete lines.  Yields for
+    # each block the block, the positions of the '>' and of the newline of each
+    # header line in it, and the number of sequence (non-whitespace) bytes in
+    # the sequence before the first header and after each header.  With
+    # base_counts, the numbers of G or C and of N bytes in them follow.
+    def iter_fasta_blocks(self, fasta_path, base_counts=False):
+        whitespace = np.zeros(33, dtype=bool)
+        whitespace[list(b' \t\n\r\f\v')] = True
+        # byte classes: 1 for N and 2 for G or C
+        classes = bytearray(256)
+        for byte_class, class_bytes in [(1, b'Nn'), (2, b'GCgc')]:
+            for b in class_bytes:
+                classes[b] = byte_class
+        classes = bytes(classes)
+
+        leftover = b''  # start of a line left unfinished by the previous block
+        with open(fasta_path, 'rb') as input_file_handle:
+            while True:
+                chunk = input_file_handle.read(self.SCAN_CHUNK_SIZE)
+                if not chunk:
+                    if not leftover:
+                        break
+                    # last line has no newline
+                    chunk = b'\n'
+                buf = leftover + chunk
+                data = np.frombuffer(buf, dtype=np.uint8)
+                # whitespace bytes, newlines included, are all <= 32, so one
+                # comparison finds them
+                spaces = np.flatnonzero(data <= 32)
+                spaces = spaces[whitespace[data[spaces]]]
+                newlines = spaces[data[spaces] == 10]
+                if len(newlines) == 0:
+                    leftover = buf
+                    continue
+                end = int(newlines[-1]) + 1
+                leftover = buf[end:]
+                if leftover:
+                    buf = buf[:end]
+                    data = data[:end]
+                    spaces = spaces[spaces < end]
+
+                # header lines are the ones starting with '>'
+                line_starts = np.concatenate(([0], newlines[:-1] + 1))
+                starts = line_starts[data[line_starts] == 62]
+                ends = newlines[np.searchsorted(newlines, starts)]
+
+                # the sequence runs from the end of each header to the next
+                # one, and the block starts with the end of the previous
+                # block's last sequence.  Whitespace and N are rare, so they
+                # are counted from their positions with searchsorted.
+                segment_starts = np.concatenate(([0], ends + 1))
+                segment_ends = np.append(starts, end)
+
+                def count_in_segments(positions):
+                    return (np.searchsorted(positions, segment_ends) -
+                            np.searchsorted(positions, segment_starts))
+                lengths = segment_ends - segment_starts - count_in_segments(spaces)
+                if not base_counts:
+                    yield buf, starts, ends, lengths
+                    continue
+                byte_classes = np.frombuffer(buf.translate(classes), dtype=np.uint8)
+
+                # G and C are not rare: sum them over the segments, with a
+                # zero at the end so that end is a valid index for reduceat
+                bounds = np.column_stack((segment_starts, segment_ends)).ravel()
+                gc = np.add.reduceat(np.append(byte_classes == 2, False), bounds,
+                                     dtype=np.int64)[0::2]
+                gc[segment_starts == segment_ends] = 0
+                n = count_in_segments(np.flatnonzero(byte_classes == 1))
+                yield buf, starts, ends, lengths, gc, n
 
     # from kb_SPAdes/utils/spades_utils.py:
     def mkdir_p(self, path):
@@ -143,37 +682,119 @@ A wrapper for the unicycler assembler
         return lines
 
     # from kb_SPAdes/utils/spades_utils.py:
-    def zip_folder(self, folder_path, output_path):
+    def zip_folder(self, folder_path, output_path, exclude=(), compresslevel=None, workers=1):
         """
         zip_folder: Zip the contents of an entire folder (with that folder included
-        in the archive). Empty subfolders could be included in the archive as well
-        if the commented portion is used.
+        in the archive), leaving out the files in exclude. Large files are deflated
+        in parallel, in up to workers processes, at compresslevel (0 stores every
+        file as it is). Returns the number of files and the bytes zipped.
         """
-        with zipfile.ZipFile(output_path, 'w',
-                             zipfile.ZIP_DEFLATED,
-                             allowZip64=True) as ziph:
-            for root, folders, files in os.walk(folder_path):
-                for f in files:
-                    absolute_path = os.path.join(root, f)
-                    relative_path = os.path.join(os.path.basename(root), f)
-                    # print "Adding {} to archive.".format(absolute_path)
-                    ziph.write(absolute_path, relative_path)
+        members = []
+        for root, folders, files in os.walk(folder_path):
+            for f in files:
+                absolute_path = os.path.join(root, f)
+                if absolute_path in exclude:
+                    continue
+                relative_path = os.path.join(os.path.basename(root), f)
+                members.append([absolute_path, relative_path, os.path.getsize(absolute_path)])
+
+        level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+        deflate_dir = os.path.join(self.scratch, str(uuid.uuid4()))
+        self.mkdir_p(deflate_dir)
+        # the workers are started by a fork server, as forking this process,
+        # which has other threads running, could deadlock them
+        mp_context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=mp_context) as executor, \
+                zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED,
+                                allowZip64=True) as ziph:
+            # start deflating all the large files, then add the members in
+            # order as they are ready
+            deflated = dict()
+            for i, [absolute_path, relative_path, size] in enumerate(members):
+                if (level != 0 and size >= self.ZIP_POOL_MIN_SIZE and
+                        not absolute_path.endswith(self.ZIP_STORED_SUFFIXES)):
+                    deflated[i] = executor.submit(
+                        deflate_zip_member, absolute_path, os.path.join(deflate_dir, str(i)),
+                        level, self.COPY_BUFFER_SIZE)
+            for i, [absolute_path, relative_path, size] in enumerate(members):
+                # print "Adding {} to archive.".format(absolute_path)
+                if i in deflated:
+                    self.add_deflated_member(ziph, absolute_path, relative_path,
+                                             os.path.join(deflate_dir, str(i)),
+                                             *deflated[i].result())
+                elif level == 0 or absolute_path.endswith(self.ZIP_STORED_SUFFIXES):
+                    ziph.write(absolute_path, relative_path, zipfile.ZIP_STORED)
+                else:
+                    ziph.write(absolute_path, relative_path, zipfile.ZIP_DEFLATED, compresslevel)
+        os.rmdir(deflate_dir)
 
         print("{} created successfully.".format(output_path))
+        return [len(members), sum(size for [_, _, size] in members)]
+
+    # append a member deflated by deflate_zip_member to an open zip file.
+    # zipfile can't take data that is already compressed, so this writes the
+    # local header itself, the way ZipFile.open does for a new member.
+    def add_deflated_member(self, ziph, path, arcname, deflated_path, crc, file_size,
+                            compress_size):
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        ziph._writecheck(zinfo)
+        ziph._didModify = True
+        ziph.fp.seek(ziph.start_dir)
+        zinfo.header_offset = ziph.fp.tell()
+        ziph.fp.write(zinfo.FileHeader())
+        with open(deflated_path, 'rb') as deflated_file:
+            copyfileobj(deflated_file, ziph.fp, self.COPY_BUFFER_SIZE)
+        ziph.start_dir = ziph.fp.tell()
+        ziph.filelist.append(zinfo)
+        ziph.NameToInfo[zinfo.filename] = zinfo
+        os.remove(deflated_path)
+
+    # the files in out_dir, apart from exclude, that belong in the output tier
+    def output_manifest(self, out_dir, tier, exclude=()):
+        manifest = []
+        for root, folders, files in os.walk(out_dir):
+            for f in files:
+                absolute_path = os.path.join(root, f)
+                if absolute_path in exclude:
+                    continue
+                if tier == 'final' and not (root == out_dir and f in self.FINAL_OUTPUT_FILES):
+                    continue
+                if tier == 'standard' and self.INTERMEDIATE_GRAPH_PATTERN.match(f):
+                    continue
+                manifest.append(absolute_path)
+        return manifest
 
     # from kb_SPAdes/utils/spades_utils.py:
-    def generate_output_file_list(self, console, out_dir):
+    def generate_output_file_list(self, console, out_dir, exclude=(), compresslevel=None,
+                                  tier='full'):
         """
-        _generate_output_file_list: zip result files and generate file_links for report
+        _generate_output_file_list: zip result files of the output tier and generate
+        file_links for report
         """
         self.log(console, 'start packing result files')
+        manifest = set(self.output_manifest(out_dir, tier, exclude))
+        exclude = [os.path.join(root, f) for root, folders, files in os.walk(out_dir)
+                   for f in files if os.path.join(root, f) not in manifest]
+        self.log(console, 'packing '+str(len(manifest))+' files ('+tier+' output, ' +
+                 str(len(exclude))+' files left out)')
 
         output_files = list()
 
         output_directory = os.path.join(self.scratch, str(uuid.uuid4()))
         self.mkdir_p(output_directory)
         unicycler_output = os.path.join(output_directory, 'unicycler_output.zip')
-        self.zip_folder(out_dir, unicycler_output)
+        start_time = time.time()
+        [n_files, n_bytes] = self.zip_folder(out_dir, unicycler_output, exclude, compresslevel,
+                                             self.detect_cpus())
+        elapsed = max(time.time() - start_time, 0.001)
+        self.log(console, 'packed {} files, {:.1f} MB into {:.1f} MB in {:.1f}s '
+                 '({:.1f} MB/s)'.format(n_files, n_bytes / 1e6,
+                                        os.path.getsize(unicycler_output) / 1e6, elapsed,
+                                        n_bytes / 1e6 / elapsed))
 
         output_files.append({'path': unicycler_output,
                              'name': os.path.basename(unicycler_output),
@@ -185,41 +806,94 @@ A wrapper for the unicycler assembler
     # adapted from kb_SPAdes/utils/spades_utils.py;
     # add templated report
 
-    def generate_report(self, console, warnings, fa_file_name, params, out_dir, wsname):
+    def generate_report(self, console, warnings, read_stats, stages, resources, contig_table,
+                        fa_file_name, quastret, output_files, params, out_dir, wsname):
         """
         Generating and saving report
         """
         self.log(console, 'Generating and saving report')
 
         fa_file_with_path = os.path.join(out_dir, fa_file_name)
-        [length_stats, coverage_stats, circ_stats] = self.load_stats(console, fa_file_with_path)
-        lengths = [length_stats[contig_id] for contig_id in length_stats]
 
         assembly_ref = wsname + '/' + params['output_contigset_name']
 
         report_text = ''
         report_text += 'Unicycler results saved to: ' + wsname + '/' + out_dir + '\n'
         report_text += 'Assembly saved to: ' + assembly_ref + '\n'
-        report_text += 'Assembled into ' + str(len(lengths)) + ' contigs.\n'
-        report_text += 'Avg Length: ' + str(sum(lengths) / float(len(lengths))) + ' bp.\n'
+        if 'long' in read_stats:
+            long_stats = read_stats['long']
+            report_text += ('Long reads: ' + str(long_stats['n_reads_kept']) + ' kept, ' +
+                            str(long_stats['n_reads_dropped']) + ' shorter than ' +
+                            str(long_stats['min_length']) + ' bp removed')
+            if long_stats['n_reads_subsampled'] > 0:
+                report_text += (', ' + str(long_stats['n_reads_subsampled']) +
+                                ' removed by subsampling to ' + str(long_stats['total_length']) +
+                                ' bases')
+            report_text += '.\n'
+        if 'short_paired' in read_stats:
+            paired_stats = read_stats['short_paired']
+            report_text += ('Short paired reads: normalized to depth ' +
+                            str(paired_stats['target_depth'])+', ' +
+                            str(paired_stats['n_pairs_kept'])+' of ' +
+                            str(paired_stats['n_pairs'])+' pairs kept.\n')
+        if 'coverage' in read_stats and read_stats['coverage']['genome_size']:
+            coverage = read_stats['coverage']
+            report_text += ('Estimated genome size: '+str(coverage['genome_size'])+' bp; depth: ' +
+                            '{:.1f}x short reads, {:.1f}x long reads'.format(
+                                coverage['short_depth'], coverage['long_depth']))
+            if 'short_downsampled_depth' in coverage:
+                report_text += '; short reads downsampled to ' + \
+                    str(coverage['short_downsampled_depth'])+'x'
+            if 'long_downsampled_depth' in coverage:
+                report_text += '; long reads downsampled to ' + \
+                    str(coverage['long_downsampled_depth'])+'x'
+            report_text += '.\n'
+        report_text += 'Assembled into ' + str(len(contig_table)) + ' contigs.\n'
+        report_text += 'Total Length: ' + str(contig_table.total_length()) + ' bp.\n'
+        report_text += 'Avg Length: ' + str(contig_table.mean_length()) + ' bp.\n'
+        [n50, l50] = contig_table.nx(0.5)
+        [n90, l90] = contig_table.nx(0.9)
+        report_text += ('N50: ' + str(n50) + ' bp (L50: ' + str(l50) + '), N90: ' + str(n90) +
+                        ' bp (L90: ' + str(l90) + '), auN: ' +
+                        '{:.1f}'.format(contig_table.aun()) + ' bp.\n')
+        if 'coverage' in read_stats and read_stats['coverage']['genome_size']:
+            [ng50, lg50] = contig_table.nx(0.5, read_stats['coverage']['genome_size'])
+            report_text += ('NG50 (estimated genome size): ' + str(ng50) + ' bp (LG50: ' +
+                            str(lg50) + ').\n')
+        report_text += 'GC content: {:.2f}% ({:.2f}% weighted by depth).\n'.format(
+            contig_table.gc_content(), contig_table.gc_content(depth_weighted=True))
+
+        if stages:
+            report_text += 'Unicycler stages (time, peak memory):\n'
+            for stage in stages:
+                seconds = int(stage['seconds'])
+                report_text += '   {}\t--\t{}:{:02d}:{:02d}, {:.1f} GB\n'.format(
+                    stage['stage'], seconds // 3600, seconds // 60 % 60, seconds % 60,
+                    stage['peak_rss'] / 1024 ** 3)
+        if resources:
+            report_text += ('Peak resource use by tool (cpu, memory, threads, ' +
+                            'read and written):\n')
+            for tool in resources:
+                report_text += ('   {}\t--\t{}%, {:.1f} GB, {} threads, '
+                                '{:.1f} / {:.1f} GB\n').format(
+                    tool['executable'], tool['cpu_percent'], tool['rss'] / 1024 ** 3,
+                    tool['threads'], tool['read_bytes'] / 1024 ** 3,
+                    tool['write_bytes'] / 1024 ** 3)
 
         # compute a simple contig length distribution
         bins = 10
-        counts, edges = np.histogram(lengths, bins)
+        counts, edges = contig_table.length_histogram(bins)
         report_text += 'Contig Length Distribution (# of contigs -- min to max ' + 'basepairs):\n'
         for c in range(bins):
             report_text += ('   ' + str(counts[c]) + '\t--\t' + str(edges[c]) + ' to ' +
                             str(edges[c + 1]) + ' bp\n')
-        self.log(console, 'Running QUAST')
-        kbq = kb_quast(self.callbackURL)
-        quastret = kbq.run_QUAST(
-            {'files': [{'path': fa_file_with_path, 'label': params['output_contigset_name']}]})
-        # self.log(console,'quastret = '+pformat(quastret))
-
-        # delete assembly file to keep it out of zip
+        # the assembly file was kept out of the zip; it isn't needed any more
         os.remove(fa_file_with_path)
 
-        # check starting genes
+        # check starting genes; unicycler's log uses the contig numbers from
+        # before the headers were rewritten
+        circ_stats = np.where(contig_table.circular, 'Y', 'N').astype(object)
+        contig_index = {contig_id: i for i, contig_id in enumerate(contig_table.contig_ids)}
         in_start = False
         ic = iter(console)
         for line in ic:
@@ -228,26 +902,44 @@ A wrapper for the unicycler assembler
                     line = next(ic)
                     # self.log(console,'debug line = '+line)
                     fields = line.strip().split()
-                    if len(fields) > 3 and fields[0] in circ_stats and circ_stats[fields[0]] == 'Y':
-                        if fields[3] == 'none':
-                            fields[3] = 'none found'
-                        circ_stats[fields[0]] = 'Y, '+fields[3]
-
-        # check circularization and make data table for report
-        contig_data = []
-        for contig_id in length_stats:
-            contig_data.append({'contig_id': contig_id,
-                                'circular': circ_stats[contig_id],
-                                'coverage': coverage_stats[contig_id],
-                                'length': length_stats[contig_id]})
+                    if len(fields) > 3:
+                        i = contig_index.get('contig_'+fields[0], contig_index.get(fields[0]))
+                        if i is not None and contig_table.circular[i]:
+                            if fields[3] == 'none':
+                                fields[3] = 'none found'
+                            circ_stats[i] = 'Y, '+fields[3]
+
+        # check circularization and make data table for report, one array
+        # per row, in the order of the columns
+        contig_data = list(zip(contig_table.contig_ids, circ_stats.tolist(),
+                               contig_table.depth.tolist(), contig_table.length.tolist(),
+                               np.round(contig_table.contig_gc(), 2).tolist()))
 
         # self.log(console, 'contig_data = '+pformat(contig_data))
 
-        # move quast output into main out_dir
-        move(os.path.join(quastret['quast_path'], 'report.html'),
-             os.path.join(out_dir, 'quast_report.html'))
+        # the report's pages go in a directory of their own, so that only
+        # they are uploaded with it, not all of unicycler's output
+        html_dir = os.path.join(self.scratch, 'report_' + str(uuid.uuid4()))
+        self.mkdir_p(html_dir)
 
-        output_files = self.generate_output_file_list(console, out_dir)
+        # move quast output into the report, and add it to the zip, which
+        # was made while quast was running, unless that has only the final
+        # output files
+        move(os.path.join(quastret['quast_path'], 'report.html'),
+             os.path.join(html_dir, 'quast_report.html'))
+        if (params.get('output_tier') or 'full') != 'final':
+            with zipfile.ZipFile(output_files[0]['path'], 'a', zipfile.ZIP_DEFLATED,
+                                 allowZip64=True) as ziph:
+                ziph.write(os.path.join(html_dir, 'quast_report.html'),
+                           os.path.join(os.path.basename(out_dir), 'quast_report.html'))
+
+        # write the log into its own page, a line at a time, rather than
+        # into the template data
+        with open(os.path.join(html_dir, 'unicycler_log.html'), 'w') as log_html:
+            log_html.write('<html><body><p><pre>')
+            for line in console:
+                log_html.write(escape(line) + '\n')
+            log_html.write('</pre></p></body></html>\n')
 
         # render template
         template_file = 'unicycler_tabs.tt'
@@ -255,10 +947,11 @@ A wrapper for the unicycler assembler
             'page_title': 'Unicycler Report',
             'data_array': contig_data,
             'cols': [
-                {'data': 'contig_id',  'title': 'Contig ID'},
-                {'data': 'circular',   'title': 'Circular, Starting Gene'},
-                {'data': 'coverage',   'title': 'Relative Coverage (x)'},
-                {'data': 'length',   'title': 'Length (bp)'}
+                {'data': 0, 'title': 'Contig ID'},
+                {'data': 1, 'title': 'Circular, Starting Gene'},
+                {'data': 2, 'title': 'Relative Coverage (x)'},
+                {'data': 3, 'title': 'Length (bp)'},
+                {'data': 4, 'title': 'GC (%)'}
             ]
         }
         # tmpl_data['quast_output'] = '<iframe>'+self.read_html(os.path.join(quastret['quast_path'],'report.html'))+'</iframe>'
@@ -266,8 +959,7 @@ A wrapper for the unicycler assembler
         tmpl_data['quast_output'] = '<iframe style="display:block; width:100%; height:100vh; border:none;" src="quast_report.html"></iframe>'
         tmpl_data['tmpl_vars'] = json.dumps(tmpl_data, sort_keys=True, indent=2)
         tmpl_data['template_content'] = self.read_template(template_file)
-        tmpl_data['unicycler_log'] = '<p><pre>'+'<br>'.join(filter(lambda line: not (
-            line.startswith('tput') or line.lstrip().startswith('0 / ')), console))+'</pre></p>'
+        tmpl_data['unicycler_log'] = '<iframe style="display:block; width:100%; height:100vh; border:none;" src="unicycler_log.html"></iframe>'
 
         # save report
         self.log(console, 'Saving report')
@@ -286,7 +978,7 @@ A wrapper for the unicycler assembler
         template_output = reportClient.render_template({
             'template_file': os.path.join(self.scratch, 'templates', template_file),
             'template_data_json': json.dumps(tmpl_data),
-            'output_file': os.path.join(out_dir, report_file)
+            'output_file': os.path.join(html_dir, report_file)
         })
 
         report_output = reportClient.create_extended_report(
@@ -294,7 +986,7 @@ A wrapper for the unicycler assembler
              'objects_created': [{'ref': assembly_ref, 'description': 'Assembled contigs'}],
              'direct_html_link_index': 0,
              'file_links': output_files,
-             'html_links': [{'path': out_dir,
+             'html_links': [{'path': html_dir,
                              'name': report_file,
                              'label': 'Unicycler report',
                              'description': 'description of template report'
@@ -306,57 +998,306 @@ A wrapper for the unicycler assembler
 
         return report_output['name'], report_output['ref']
 
-    # get short paired reads, and combine into forward and reverse files
-    def download_short_paired(self, console, token, wsname, short_paired_libraries):
+    # save the assembly to the workspace, marking the circular contigs
+    def save_assembly(self, console, token, params, contigs_path, contig_table):
         try:
-            ruClient = ReadsUtils(url=self.callbackURL, token=token)
+            contig_info = {contig_id: {'is_circ': int(circular)} for contig_id, circular in
+                           zip(contig_table.contig_ids, contig_table.circular.tolist())}
+            auClient = AssemblyUtil(url=self.callbackURL, token=token, service_ver='release')
+            auClient.save_assembly_from_fasta(
+                {'file': {'path': contigs_path},
+                 'workspace_name': params['workspace_name'],
+                 'assembly_name': params['output_contigset_name'],
+                 'contig_info': contig_info})
+        except Exception as e:
+            raise ValueError('Error saving assembly\n' + str(e))
+        self.log(console, 'Assembly saved')
 
-            # first, unpack any ReadsSets into the actual PairedEndLibrary referencs
-            reads_refs = []
-            # object info
+    def run_quast(self, console, contigs_path, label):
+        self.log(console, 'Running QUAST')
+        kbq = kb_quast(self.callbackURL)
+        quastret = kbq.run_QUAST({'files': [{'path': contigs_path, 'label': label}]})
+        # self.log(console,'quastret = '+pformat(quastret))
+        return quastret
+
+    # write a QUAST-like report.html of the assembly metrics, from the contig
+    # table, into a new directory in scratch; returns it the way run_quast does
+    def builtin_assembly_metrics(self, console, contig_table, label, genome_size=None):
+        self.log(console, 'Computing assembly metrics')
+        rows = []
+        for threshold in self.METRICS_LENGTH_THRESHOLDS:
+            keep = contig_table.length >= threshold
+            rows.append(['# contigs (>= '+str(threshold)+' bp)', int(keep.sum())])
+        for threshold in self.METRICS_LENGTH_THRESHOLDS:
+            keep = contig_table.length >= threshold
+            rows.append(['Total length (>= '+str(threshold)+' bp)',
+                         int(contig_table.length[keep].sum())])
+        rows.append(['Largest contig', int(contig_table.sorted_length[0])
+                     if len(contig_table) else 0])
+        if genome_size:
+            rows.append(['Estimated reference length', genome_size])
+        rows.append(['GC (%)', '{:.2f}'.format(contig_table.gc_content())])
+        for fraction in [0.5, 0.9]:
+            [nx, lx] = contig_table.nx(fraction)
+            rows.append(['N'+str(int(fraction*100)), nx])
+            rows.append(['L'+str(int(fraction*100)), lx])
+        if genome_size:
+            for fraction in [0.5, 0.9]:
+                [ngx, lgx] = contig_table.nx(fraction, genome_size)
+                rows.append(['NG'+str(int(fraction*100)), ngx if ngx else '-'])
+                rows.append(['LG'+str(int(fraction*100)), lgx if lgx else '-'])
+        rows.append(['auN', '{:.1f}'.format(contig_table.aun())])
+        rows.append(["# N's per 100 kbp", '{:.2f}'.format(
+            100000.0 * contig_table.n.sum() / max(contig_table.total_length(), 1))])
+        rows.append(['# circular contigs', int(contig_table.circular.sum())])
+
+        report_dir = os.path.join(self.scratch, str(uuid.uuid4()))
+        self.mkdir_p(report_dir)
+        with open(os.path.join(report_dir, 'report.html'), 'w') as report:
+            report.write('<html><head><title>Assembly metrics</title></head><body>\n')
+            report.write('<h3>Assembly metrics</h3>\n<table border="1" cellpadding="4">\n')
+            report.write('<tr><th>Metric</th><th>'+escape(label)+'</th></tr>\n')
+            for [name, value] in rows:
+                report.write('<tr><td>'+escape(name)+'</td><td>'+str(value)+'</td></tr>\n')
+            report.write('</table>\n<p>All statistics are based on contigs of all sizes, '
+                         'unless stated otherwise.</p>\n</body></html>\n')
+        return {'quast_path': report_dir}
+
+    # save the assembly, run QUAST on it (or compute the builtin metrics),
+    # and zip the output directory (all but the rewritten assembly) at the
+    # same time.  Returns the QUAST results and the output file list once
+    # all three are done.
+    def run_post_assembly(self, console, token, params, contigs_path, contig_table, out_dir,
+                          quast_mode='full', genome_size=None):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            save = executor.submit(self.save_assembly, console, token, params, contigs_path,
+                                   contig_table)
+            if quast_mode == 'builtin':
+                quast = executor.submit(self.builtin_assembly_metrics, console, contig_table,
+                                        params['output_contigset_name'], genome_size)
+            else:
+                quast = executor.submit(self.run_quast, console, contigs_path,
+                                        params['output_contigset_name'])
+            output_files = executor.submit(self.generate_output_file_list, console, out_dir,
+                                           [contigs_path], params.get('zip_compresslevel'),
+                                           params.get('output_tier') or 'full')
+        errors = [str(f.exception()) for f in [save, quast, output_files]
+                  if f.exception() is not None]
+        if errors:
+            raise ValueError('\n'.join(errors))
+        return [quast.result(), output_files.result()]
+
+    # look up the object info of all input libraries in a single workspace
+    # call.  Returns a dict from each library name or reference, as given in
+    # the params, to its versioned reference (wsid/objid/ver), its type
+    # (without version) and its object info; the dict serves as the cache
+    # of library references for the rest of the job.
+    def resolve_library_refs(self, console, token, wsname, libraries):
+        libraries = list(dict.fromkeys(libraries))  # drop duplicates, keep order
+        if not libraries:
+            return dict()
+        try:
+            wsClient = Workspace(self.workspaceURL, token=token)
+        except Exception as e:
+            raise ValueError("unable to instantiate wsClient. "+str(e))
+
+        [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
+            WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
+        obj_ids = [{'ref': lib if '/' in lib else (wsname + '/' + lib)} for lib in libraries]
+        try:
+            infos = wsClient.get_object_info_new({'objects': obj_ids,
+                                                  'includeMetadata': 1,
+                                                  'ignoreErrors': 1})
+        except Exception as e:
+            raise ValueError('Unable to get read library objects: ' + str(e))
+
+        lib_infos = dict()
+        missing = []
+        for lib, info in zip(libraries, infos):
+            if info is None:
+                missing.append(lib)
+                continue
+            lib_infos[lib] = {
+                'ref': str(info[WSID_I])+'/'+str(info[OBJID_I])+'/'+str(info[VERSION_I]),
+                'type': re.sub(r'-[0-9]+\.[0-9]+$', "", info[TYPE_I]),  # remove trailing version
+                'info': info
+            }
+            self.log(console, 'library '+lib+' is '+lib_infos[lib]['type'] +
+                     ' '+lib_infos[lib]['ref'])
+        if missing:
+            raise ValueError('Unable to get read library object(s): ' + ', '.join(missing))
+        return lib_infos
+
+    # get the member libraries of every ReadsSet among the inputs.  One SetAPI
+    # client is shared, and the sets are fetched concurrently.  Returns a dict
+    # from set ref to member refs.
+    def expand_reads_sets(self, console, token, lib_infos, max_workers):
+        set_refs = list(dict.fromkeys([lib_infos[lib]['ref'] for lib in lib_infos
+                                       if lib_infos[lib]['type'] == 'KBaseSets.ReadsSet']))
+        if not set_refs:
+            return dict()
+        setAPIClient = SetAPI(url=self.serviceWizardURL, token=token)
+
+        def get_set(set_ref):
+            self.log(console, 'getting reads set '+set_ref)
             try:
-                wsClient = Workspace(self.workspaceURL, token=token)
+                readsSet = setAPIClient.get_reads_set_v1({'ref': set_ref, 'include_item_info': 1})
             except Exception as e:
-                raise ValueError("unable to instantiate wsClient. "+str(e))
-
-            [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
-                WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-            for lib in short_paired_libraries:
+                raise ValueError(
+                    'SetAPI FAILURE: Unable to get read library set object: (' + set_ref + ')\n' + str(e))
+            return [readsLibrary['ref'] for readsLibrary in readsSet['data']['items']]
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(set_refs)))) as executor:
+            set_items = dict(zip(set_refs, executor.map(get_set, set_refs)))
+        return set_items
+
+    # unpack any ReadsSets into the actual reads library references, dropping
+    # libraries that were already listed, so none is downloaded twice
+    def get_reads_refs(self, console, libraries, lib_infos, set_items):
+        reads_refs = []
+        for lib in libraries:
+            lib_ref = lib_infos[lib]['ref']
+            if lib_ref in set_items:
+                reads_refs.extend(set_items[lib_ref])
+            else:
+                # use other reads objects "as is"
+                reads_refs.append(lib_ref)
+        unique_refs = list(dict.fromkeys(reads_refs))
+        if len(unique_refs) < len(reads_refs):
+            self.log(console, 'skipping '+str(len(reads_refs) - len(unique_refs)) +
+                     ' reads libraries listed more than once')
+        return unique_refs
+
+    # download reads libraries one per ReadsUtils call, so they are fetched in
+    # parallel and a failure can be pinned on the library that caused it.
+    # download_slots caps the number of downloads running across all callers.
+    def download_reads_files(self, console, token, reads_refs, download_slots):
+        ruClient = ReadsUtils(url=self.callbackURL, token=token)
+
+        def download_one(reads_ref):
+            with download_slots:
+                self.log(console, 'downloading reads library '+reads_ref)
+                start = time.time()
+                result = ruClient.download_reads({'read_libraries': [reads_ref],
+                                                  'interleaved': 'false'})
+                self.log(console, 'downloaded reads library '+reads_ref+' in ' +
+                         '{:.1f}'.format(time.time() - start)+' s')
+                return result['files'][reads_ref]
+
+        files = dict()
+        failures = []
+        with ThreadPoolExecutor(max_workers=max(1, len(reads_refs))) as executor:
+            futures = [(reads_ref, executor.submit(download_one, reads_ref))
+                       for reads_ref in reads_refs]
+            for reads_ref, future in futures:
                 try:
-                    obj_id = {'ref': lib if '/' in lib else (wsname + '/' + lib)}
-                    lib_obj_info = wsClient.get_object_info_new({'objects': [obj_id]})[0]
-                    lib_obj_type = lib_obj_info[TYPE_I]
-                    # remove trailing version
-                    lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_type)
-                    lib_ref = str(lib_obj_info[WSID_I])+'/' + \
-                        str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
-                    if lib_obj_type == 'KBaseSets.ReadsSet':
-                        # unpack it
-                        try:
-                            setAPIClient = SetAPI(url=self.serviceWizardURL, token=token)
-                            self.log(console, 'getting reads set '+lib_ref)
-                            readsSet = setAPIClient.get_reads_set_v1(
-                                {'ref': lib_ref, 'include_item_info': 1})
-                        except Exception as e:
-                            raise ValueError(
-                                'SetAPI FAILURE: Unable to get read library set object: (' + lib_ref + ')\n' + str(e))
-                        for readsLibrary in readsSet['data']['items']:
-                            reads_refs.append(readsLibrary['ref'])
-                    else:
-                        # use other reads objects "as is"
-                        reads_refs.append(lib_ref)
+                    files[reads_ref] = future.result()
                 except Exception as e:
-                    raise ValueError(
-                        'Unable to get read library object: (' + str(lib) + ')' + str(e))
-
-            # download all reads refs in one call, in separate files
+                    failures.append(reads_ref+': '+str(e))
+        if failures:
+            raise ValueError('Unable to download '+str(len(failures))+' of ' +
+                             str(len(reads_refs))+' reads libraries:\n'+'\n'.join(failures))
+        return {'files': files}
+
+    # copy all of a plain file into another, in the kernel where possible
+    def copy_file_data(self, in_file, out_file):
+        in_fd = in_file.fileno()
+        out_fd = out_file.fileno()
+        try:
+            while os.copy_file_range(in_fd, out_fd, self.COPY_BUFFER_SIZE) > 0:
+                pass
+            return
+        except (AttributeError, OSError):
+            pass
+        try:
+            while os.sendfile(out_fd, in_fd, None, self.COPY_BUFFER_SIZE) > 0:
+                pass
+            return
+        except OSError:
+            pass
+        copyfileobj(in_file, out_file, self.COPY_BUFFER_SIZE)
+
+    # append a reads file to out_path, compressing or decompressing it to
+    # match out_path.  Gzipped files are appended to a gzipped out_path as they
+    # are, since concatenated gzip members are themselves a valid gzip file.
+    def append_reads_file(self, console, in_path, out_path):
+        start = time.time()
+        start_size = os.path.getsize(out_path) if os.path.exists(out_path) else 0
+        if out_path.endswith('.gz') and not in_path.endswith('.gz'):
+            # compress into a new gzip member at the end of out_path
+            if igzip_threaded is not None:
+                out_file = igzip_threaded.open(
+                    out_path, 'ab', compresslevel=self.COMBINED_READS_COMPRESSLEVEL,
+                    threads=self.detect_cpus())
+            else:
+                out_file = gzip.open(out_path, 'ab',
+                                     compresslevel=self.COMBINED_READS_COMPRESSLEVEL)
+            with open(in_path, 'rb') as in_file, out_file:
+                copyfileobj(in_file, out_file, self.COPY_BUFFER_SIZE)
+        else:
+            # not opened in append mode: copy_file_range and sendfile refuse O_APPEND
+            with open(out_path, 'r+b' if os.path.exists(out_path) else 'wb') as out_file:
+                out_file.seek(0, os.SEEK_END)
+                if in_path.endswith('.gz') and not out_path.endswith('.gz'):
+                    if igzip_threaded is not None:
+                        in_file = igzip_threaded.open(in_path, 'rb')
+                    else:
+                        in_file = gzip.open(in_path, 'rb')
+                    with in_file:
+                        copyfileobj(in_file, out_file, self.COPY_BUFFER_SIZE)
+                else:
+                    with open(in_path, 'rb') as in_file:
+                        out_file.flush()
+                        self.copy_file_data(in_file, out_file)
+        n_bytes = os.path.getsize(out_path) - start_size
+        elapsed = max(time.time() - start, 1e-6)
+        self.log(console, 'appended {} to {}: {} bytes in {:.1f} s ({:.1f} MB/s)'.format(
+            in_path, out_path, n_bytes, elapsed, n_bytes / elapsed / 1e6))
+        return n_bytes
+
+    # file extension for combined reads: gzipped when asked for, and with
+    # direct input also when every input file already is gzipped, so
+    # nothing needs to be decompressed
+    def combined_reads_suffix(self, result, direct_input, compress):
+        paths = [reads_files['files'][direction] for reads_files in result['files'].values()
+                 for direction in ['fwd', 'rev'] if reads_files['files'].get(direction)]
+        if compress or (direct_input and paths and all([path.endswith('.gz') for path in paths])):
+            return '.fastq.gz'
+        return '.fastq'
+
+    # get short paired reads, and combine into forward and reverse files,
+    # normalizing them to target_depth if it is set
+    def download_short_paired(self, console, read_stats, token, reads_refs, download_slots,
+                              direct_input=False, compress=False, target_depth=None):
+        try:
+            # download all reads refs, in separate files
             self.log(console, "Getting short paired end reads.\n")
-            result = ruClient.download_reads({'read_libraries': reads_refs,
-                                              'interleaved': 'false'})
+            result = self.download_reads_files(console, token, reads_refs, download_slots)
+
+            # with direct input and a single library there is nothing to
+            # combine; unicycler reads the downloaded files where they are
+            if direct_input and len(reads_refs) == 1 and not target_depth:
+                files = result['files'][reads_refs[0]]['files']
+                if 'fwd' not in files or 'rev' not in files:
+                    raise ValueError('File '+reads_refs[0]+' missing forward or reverse reads file')
+                self.log(console, "Using downloaded short paired end reads directly.\n")
+                return files['fwd'], files['rev']
 
             # combine outputs
-            short_fwd_path = os.path.join(self.scratch, "short_fwd_"+str(uuid.uuid4())+".fastq")
-            short_rev_path = os.path.join(self.scratch, "short_rev_"+str(uuid.uuid4())+".fastq")
+            suffix = self.combined_reads_suffix(result, direct_input, compress)
+            short_fwd_path = os.path.join(self.scratch, "short_fwd_"+str(uuid.uuid4())+suffix)
+            short_rev_path = os.path.join(self.scratch, "short_rev_"+str(uuid.uuid4())+suffix)
+
+            if target_depth:
+                self.log(console, "Normalizing short paired end reads to depth " +
+                         str(target_depth)+".\n")
+                [n_pairs, n_pairs_kept] = self.normalize_short_paired(
+                    console, result, reads_refs, target_depth, short_fwd_path, short_rev_path)
+                read_stats['short_paired'] = {'n_pairs': n_pairs,
+                                              'n_pairs_kept': n_pairs_kept,
+                                              'target_depth': target_depth}
+                return short_fwd_path, short_rev_path
+
             self.log(console, "Combining short paired end reads.\n")
 
             for reads_ref in reads_refs:
@@ -365,31 +1306,13 @@ A wrapper for the unicycler assembler
 
                 if 'fwd' in files:
                     path = files['fwd']
-                    if path.endswith('.gz'):
-                        cmd = 'gzip -dc '+path+' >> '+short_fwd_path
-                    else:
-                        cmd = 'cat '+path+' >> '+short_fwd_path
-                    self.log(console, "command: "+cmd)
-                    cmdProcess = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                    cmdProcess.wait()
-                    if cmdProcess.returncode != 0:
-                        raise ValueError('Error running '+cmd)
+                    self.append_reads_file(console, path, short_fwd_path)
                     os.remove(path)
                 else:
                     raise ValueError('File '+reads_ref+' missing forward reads file')
                 if 'rev' in files:
                     path = files['rev']
-                    if path.endswith('.gz'):
-                        cmd = 'gzip -dc '+path+' >> '+short_rev_path
-                    else:
-                        cmd = 'cat '+path+' >> '+short_rev_path
-                    self.log(console, "command: "+cmd)
-                    cmdProcess = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                    cmdProcess.wait()
-                    if cmdProcess.returncode != 0:
-                        raise ValueError('Error running '+cmd)
+                    self.append_reads_file(console, path, short_rev_path)
                     os.remove(path)
                 else:
                     raise ValueError('File '+reads_ref+' missing reverse reads file')
@@ -400,54 +1323,25 @@ A wrapper for the unicycler assembler
         return short_fwd_path, short_rev_path
 
     # get short unpaired reads, and combine into one file
-    def download_short_unpaired(self, console, token, wsname, short_unpaired_libraries):
+    def download_short_unpaired(self, console, token, reads_refs, download_slots,
+                                direct_input=False, compress=False):
         try:
             self.log(console, "Getting short unpaired reads.\n")
-            ruClient = ReadsUtils(url=self.callbackURL, token=token)
 
-            # first, unpack any ReadsSets into the actual SingleEndLibrary referencs
-            reads_refs = []
-            # object info
-            try:
-                wsClient = Workspace(self.workspaceURL, token=token)
-            except Exception as e:
-                raise ValueError("unable to instantiate wsClient. "+str(e))
+            result = self.download_reads_files(console, token, reads_refs, download_slots)
 
-            [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
-                WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-            for lib in short_unpaired_libraries:
-                try:
-                    obj_id = {'ref': lib if '/' in lib else (wsname + '/' + lib)}
-                    lib_obj_info = wsClient.get_object_info_new({'objects': [obj_id]})[0]
-                    lib_obj_type = lib_obj_info[TYPE_I]
-                    # remove trailing version
-                    lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_type)
-                    lib_ref = str(lib_obj_info[WSID_I])+'/' + \
-                        str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
-                    if lib_obj_type == 'KBaseSets.ReadsSet':
-                        # unpack it
-                        try:
-                            setAPIClient = SetAPI(url=self.serviceWizardURL, token=token)
-                            self.log(console, 'getting reads set '+lib_ref)
-                            readsSet = setAPIClient.get_reads_set_v1(
-                                {'ref': lib_ref, 'include_item_info': 1})
-                        except Exception as e:
-                            raise ValueError(
-                                'SetAPI FAILURE: Unable to get read library set object: (' + lib_ref + ')\n' + str(e))
-                        for readsLibrary in readsSet['data']['items']:
-                            reads_refs.append(readsLibrary['ref'])
-                    else:
-                        # use other reads objects "as is"
-                        reads_refs.append(lib_ref)
-                except Exception as e:
-                    raise ValueError(
-                        'Unable to get read library object: (' + str(lib) + ')' + str(e))
+            # with direct input and a single library there is nothing to combine
+            if direct_input and len(reads_refs) == 1:
+                files = result['files'][reads_refs[0]]['files']
+                if 'fwd' not in files:
+                    raise ValueError('File '+reads_refs[0]+' missing forward reads file')
+                self.log(console, "Using downloaded short unpaired reads directly.\n")
+                return files['fwd']
 
-            result = ruClient.download_reads({'read_libraries': reads_refs,
-                                              'interleaved': 'false'})
             # combine outputs
             short_unpaired_path = os.path.join(
-                self.scratch, "short_unpaired_"+str(uuid.uuid4())+".fastq")
+                self.scratch, "short_unpaired_"+str(uuid.uuid4()) +
+                self.combined_reads_suffix(result, direct_input, compress))
 
             self.log(console, "Combining short unpaired reads.\n")
 
@@ -456,16 +1350,7 @@ A wrapper for the unicycler assembler
 
                 if 'fwd' in files:
                     path = files['fwd']
-                    if path.endswith('.gz'):
-                        cmd = 'gzip -dc '+path+' >> '+short_unpaired_path
-                    else:
-                        cmd = 'cat '+path+' >> '+short_unpaired_path
-                    self.log(console, "command: "+cmd)
-                    cmdProcess = subprocess.Popen(
-                        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-                    cmdProcess.wait()
-                    if cmdProcess.returncode != 0:
-                        raise ValueError('Error running '+cmd)
+                    self.append_reads_file(console, path, short_unpaired_path)
                     os.remove(path)
                 else:
                     raise ValueError('File '+reads_ref+' missing forward reads file')
@@ -475,89 +1360,689 @@ A wrapper for the unicycler assembler
         return short_unpaired_path
 
     # get long reads
-    def download_long(self, console, warnings, token, wsname, lib, min_long_read_length):
+    def download_long(self, console, warnings, read_stats, token, lib, lib_infos,
+                      min_long_read_length, long_read_target_bases, download_slots):
         try:
-            # object info
-            try:
-                wsClient = Workspace(self.workspaceURL, token=token)
-            except Exception as e:
-                raise ValueError("unable to instantiate wsClient. "+str(e))
-
-            [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I,
-                WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)  # object_info tuple
-
-            obj_id = {'ref': lib if '/' in lib else (wsname + '/' + lib)}
-            lib_obj_info = wsClient.get_object_info_new({'objects': [obj_id]})[0]
-            lib_obj_type = lib_obj_info[TYPE_I]
-            lib_obj_type = re.sub('-[0-9]+\.[0-9]+$', "", lib_obj_type)  # remove trailing version
-            lib_ref = str(lib_obj_info[WSID_I])+'/' + \
-                str(lib_obj_info[OBJID_I])+'/'+str(lib_obj_info[VERSION_I])
+            lib_ref = lib_infos[lib]['ref']
+            lib_obj_type = lib_infos[lib]['type']
             total_read_length = 0
             if lib_obj_type == 'KBaseGenomes.ContigSet' or lib_obj_type == 'KBaseGenomeAnnotations.Assembly':
                 # download using assembly util / data file util
                 self.log(console, "Getting long reads (from contigs object).\n")
                 auClient = AssemblyUtil(url=self.callbackURL, token=token)
                 dfuClient = DataFileUtil(url=self.callbackURL, token=token)
-                contig_file = auClient.get_assembly_as_fasta({'ref': lib_ref}).get('path')
+                with download_slots:
+                    contig_file = auClient.get_assembly_as_fasta({'ref': lib_ref}).get('path')
                 long_reads_path = dfuClient.unpack_file({'file_path': contig_file})['file_path']
                 self.log(
                     warnings, "Warning:  Long reads are in FASTA format, so short read check was not performed.")
 
             else:
-                ruClient = ReadsUtils(url=self.callbackURL, token=token)
                 self.log(console, "Getting long reads (from reads library object).\n")
-                result = ruClient.download_reads({'read_libraries': [lib_ref],
-                                                  'interleaved': 'false'})
-                long_reads_path = result['files'][lib_ref]['files']['fwd']
-                [n_reads, n_reads_short, total_read_length] = self.filter_short_fastq(
-                    console, long_reads_path, min_long_read_length)
+                result = self.download_reads_files(console, token, [lib_ref], download_slots)
+                downloaded_path = result['files'][lib_ref]['files']['fwd']
+
+                filtered_path = os.path.join(
+                    self.scratch, "long_filtered_"+str(uuid.uuid4())+".fastq")
+                if long_read_target_bases:
+                    # keep the best reads, up to the target number of bases
+                    [n_reads, n_reads_short, n_reads_kept, total_read_length] = \
+                        self.subsample_fastq(console, downloaded_path, min_long_read_length,
+                                             long_read_target_bases, filtered_path)
+                else:
+                    # count the reads and drop the short ones in the same pass
+                    [n_reads, n_reads_short, total_read_length, short_read_length] = \
+                        self.filter_short_fastq(console, downloaded_path, min_long_read_length,
+                                                filtered_path, self.MAX_LONG_READ_BASES)
+                    total_read_length -= short_read_length
+                    n_reads_kept = n_reads - n_reads_short
+                read_stats['long'] = {'n_reads': n_reads,
+                                      'n_reads_kept': n_reads_kept,
+                                      'n_reads_dropped': n_reads_short,
+                                      'n_reads_subsampled': n_reads - n_reads_short - n_reads_kept,
+                                      'total_length': total_read_length,
+                                      'min_length': min_long_read_length}
 
                 if (n_reads_short > 0):
-                    self.log(warnings, "Warning:  Of "+str(n_reads)+" long reads, "+str(n_reads_short)+" are shorter than " +
-                             str(min_long_read_length)+"; consider using the filtlong app to filter out shorter reads.")
+                    self.log(warnings, "Warning:  Of "+str(n_reads)+" long reads, "+str(n_reads_short)+" were shorter than " +
+                             str(min_long_read_length)+" bp and have been removed.")
+                if n_reads_kept < n_reads:
+                    long_reads_path = filtered_path
+                    os.remove(downloaded_path)
+                else:
+                    long_reads_path = downloaded_path
+                    if os.path.exists(filtered_path):
+                        os.remove(filtered_path)
 
         except Exception as e:
             raise ValueError('Unable to download long reads\n' + str(e))
-        if (total_read_length > 1000000000):
-            raise ValueError('Too many long reads; total length is limited to 1 GB and you have '+str(total_read_length)+' B.  Use filtlong app to filter out lower quality reads.')
+        if (total_read_length > self.MAX_LONG_READ_BASES):
+            raise ValueError('Too many long reads; total length is limited to 1 GB and you have at least '+str(total_read_length)+' B.  Set a long read target to subsample them, or use filtlong app to filter out lower quality reads.')
         return long_reads_path
 
-    # examine fastq files, count total read length
-    def filter_short_fastq(self, console, fastq_path, min_length):
+    # fail before downloading anything if the workspace metadata of the long
+    # reads library shows it is over the size limit and won't be subsampled.
+    # The limit applies to the reads left once those under min_length are
+    # removed; the metadata has no read lengths, so each read is taken to be
+    # just under min_length, which is the most that could be removed.
+    def check_long_reads_size(self, console, lib_info, long_read_target_bases, min_length):
+        if long_read_target_bases:
+            return
+        META_I = 10  # object_info tuple
+        meta = lib_info['info'][META_I] or dict()
+        try:
+            read_count = int(float(meta['read_count'])) if 'read_count' in meta else None
+            if 'total_bases' in meta:
+                total_bases = int(float(meta['total_bases']))
+            elif read_count is not None and 'read_length_mean' in meta:
+                total_bases = int(read_count * float(meta['read_length_mean']))
+            else:
+                return
+        except (TypeError, ValueError):
+            return
+        min_length = int(min_length or 0)
+        if min_length > 1:
+            if read_count is None:
+                return
+            kept_bases = total_bases - read_count * (min_length - 1)
+        else:
+            kept_bases = total_bases
+        self.log(console, 'long reads library '+lib_info['ref']+' has '+str(total_bases) +
+                 ' bases, at least '+str(max(kept_bases, 0))+' of them in reads of at least ' +
+                 str(min_length)+' bp')
+        if kept_bases > self.MAX_LONG_READ_BASES:
+            raise ValueError('Too many long reads; total length is limited to 1 GB and you have at least '+str(kept_bases)+' B.  Set a long read target to subsample them, or use filtlong app to filter out lower quality reads.')
+
+    # open a reads file for binary reading, decompressing it if it is gzipped.
+    # With raw_file, the file already opened at path, read from that (the
+    # caller closes it) without reading ahead, so that its position is how
+    # far the reads have been decompressed.
+    def open_reads_file(self, path, raw_file=None):
+        with open(path, 'rb') as f:
+            gzipped = f.read(2) == b'\x1f\x8b'
+        if raw_file is not None:
+            return gzip.GzipFile(fileobj=raw_file, mode='rb') if gzipped else raw_file
+        if not gzipped:
+            return open(path, 'rb', buffering=self.SCAN_CHUNK_SIZE)
+        if igzip_threaded is not None:
+            return igzip_threaded.open(path, 'rb')
+        return gzip.open(path, 'rb')
+
+    # read a fastq file in large chunks, yielding for each chunk a buffer of
+    # complete records and an (n_records, 4) array of the positions of their
+    # line ends, found with numpy.  Records are taken to be four lines long.
+    # With raw_position, a list, its first item is set to how far into the
+    # file (compressed, if it is gzipped) has been read.
+    def iter_fastq_records(self, console, fastq_path, raw_position=None):
+        leftover = b''  # start of a record left unfinished by the previous chunk
+        with open(fastq_path, 'rb') as raw_file, \
+                self.open_reads_file(fastq_path, raw_file if raw_position is not None
+                                     else None) as input_file_handle:
+            while True:
+                chunk = input_file_handle.read(self.SCAN_CHUNK_SIZE)
+                if raw_position is not None:
+                    raw_position[0] = raw_file.tell()
+                if not chunk:
+                    if not leftover or leftover.endswith(b'\n'):
+                        break
+                    # last line has no newline
+                    chunk = b'\n'
+                buf = leftover + chunk
+                line_ends = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == 10)
+                n_records = len(line_ends) // 4
+                if n_records == 0:
+                    leftover = buf
+                    continue
+                line_ends = line_ends[:n_records * 4].reshape(n_records, 4)
+                yield buf, line_ends
+                leftover = buf[line_ends[-1, 3] + 1:]
+        if leftover.strip():
+            self.log(console, 'Warning: ignoring incomplete last record of '+fastq_path)
+
+    # length of each record's sequence, not counting the line terminator
+    def fastq_seq_lengths(self, buf, line_ends):
+        data = np.frombuffer(buf, dtype=np.uint8)
+        seq_lengths = line_ends[:, 1] - line_ends[:, 0] - 1
+        # don't count the carriage return of a windows line ending
+        seq_lengths -= (seq_lengths > 0) & (data[line_ends[:, 1] - 1] == 13)
+        return seq_lengths
+
+    # write the records of a chunk for which keep is true, each run of
+    # consecutive kept records with a single write.  start is where the first
+    # record begins, for line_ends that are a slice of a chunk's.
+    def write_fastq_records(self, output_file, buf, line_ends, keep, start=0):
+        record_ends = line_ends[:, 3] + 1
+        view = memoryview(buf)
+        if keep.all():
+            output_file.write(view[start:record_ends[-1]])
+        else:
+            record_starts = np.concatenate(([start], record_ends[:-1]))
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], keep.astype(np.int8), [0]))))
+            for first, last in zip(edges[0::2], edges[1::2]):
+                output_file.write(view[record_starts[first]:record_ends[last - 1]])
+        view.release()
+
+    # examine fastq files, count total read length, and if output_path is
+    # given, write the reads that are at least min_length long to it.  The
+    # output is only written if there are short reads to leave out; until the
+    # first one, the reads are just counted, and then the ones before it are
+    # copied over.  If the reads that are long enough add up to more than
+    # max_bases, the scan stops there, and the counts only cover the file up
+    # to that point.
+    # Returns the number of reads, the number shorter than min_length, and
+    # the total length of all reads and of the short ones.
+    def filter_short_fastq(self, console, fastq_path, min_length, output_path=None,
+                           max_bases=None):
         n_reads = 0
         n_reads_short = 0
         total_read_length = 0
-        with open(fastq_path, 'r') as input_file_handle:
-            for current_line in input_file_handle:
-                if (current_line[0] == '@'):
-                    # self.log(console, 'fastq header = '+current_line)
-                    n_reads += 1
-                    seq = next(input_file_handle)
-                    if len(seq) < min_length:
-                        n_reads_short += 1
-                    total_read_length += len(seq)
-                    next(input_file_handle)
-                    next(input_file_handle)
-            self.log(console, str(n_reads)+' long reads found, ' +
-                     str(n_reads_short)+' under '+str(min_length)+' bp')
-        return [n_reads, n_reads_short, total_read_length]
-    
-    def _rewrite_headers(self, fasta_path: Path) -> str:
+        short_read_length = 0
+        output_file = None
+        buf_start = 0  # offset in the uncompressed reads of the start of buf
+        try:
+            for buf, line_ends in self.iter_fastq_records(console, fastq_path):
+                seq_lengths = self.fastq_seq_lengths(buf, line_ends)
+                is_short = seq_lengths < min_length
+                n_reads += len(seq_lengths)
+                n_reads_short += int(np.count_nonzero(is_short))
+                total_read_length += int(seq_lengths.sum())
+                short_read_length += int(seq_lengths[is_short].sum())
+                if output_path and output_file is None and n_reads_short:
+                    output_file = open(output_path, 'wb', buffering=self.SCAN_CHUNK_SIZE)
+                    self.copy_reads_prefix(fastq_path, buf_start, output_file)
+                if output_file is not None:
+                    self.write_fastq_records(output_file, buf, line_ends, ~is_short)
+                buf_start += int(line_ends[-1, 3]) + 1
+                if max_bases is not None and total_read_length - short_read_length > max_bases:
+                    self.log(console, 'stopped reading '+fastq_path+' after ' +
+                             str(total_read_length - short_read_length)+' bases; limit is ' +
+                             str(max_bases))
+                    break
+        finally:
+            if output_file is not None:
+                output_file.close()
+        self.log(console, str(n_reads)+' long reads found, ' +
+                 str(n_reads_short)+' under '+str(min_length)+' bp')
+        return [n_reads, n_reads_short, total_read_length, short_read_length]
+
+    # copy the first n_bytes of a reads file, uncompressed, to output_file
+    def copy_reads_prefix(self, path, n_bytes, output_file):
+        with self.open_reads_file(path) as input_file_handle:
+            while n_bytes > 0:
+                chunk = input_file_handle.read(min(n_bytes, self.SCAN_CHUNK_SIZE))
+                if not chunk:
+                    break
+                output_file.write(chunk)
+                n_bytes -= len(chunk)
+
+    # write the reads with the most expected correct bases (length times mean
+    # base accuracy) that are at least min_length long, up to a total of
+    # target_bases.  The first pass only keeps a length and a score per read;
+    # the second writes the selected reads.  Returns the number of reads, the
+    # number shorter than min_length, the number written and their total length.
+    def subsample_fastq(self, console, fastq_path, min_length, target_bases, output_path):
+        # probability that a base is right, by phred+33 quality character
+        accuracy = np.zeros(256, dtype=np.float32)
+        accuracy[33:127] = 1 - 10 ** (-np.arange(94, dtype=np.float32) / 10)
+
+        lengths = []
+        scores = []
+        for buf, line_ends in self.iter_fastq_records(console, fastq_path):
+            data = np.frombuffer(buf, dtype=np.uint8)
+            seq_lengths = self.fastq_seq_lengths(buf, line_ends)
+            qual_starts = line_ends[:, 2] + 1
+            qual_ends = line_ends[:, 3] - (data[line_ends[:, 3] - 1] == 13)
+            cumulative = np.concatenate(([0.0], np.cumsum(accuracy[data], dtype=np.float64)))
+            qual_sums = cumulative[qual_ends] - cumulative[qual_starts]
+            mean_accuracy = qual_sums / np.maximum(qual_ends - qual_starts, 1)
+            lengths.append(seq_lengths)
+            scores.append(seq_lengths * mean_accuracy)
+        lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+        scores = np.concatenate(scores) if scores else np.zeros(0)
+
+        # best reads first, until the budget is used up
+        eligible = np.flatnonzero(lengths >= min_length)
+        order = eligible[np.argsort(-scores[eligible], kind='stable')]
+        n_selected = int(np.searchsorted(np.cumsum(lengths[order]), target_bases, side='right'))
+        keep = np.zeros(len(lengths), dtype=bool)
+        keep[order[:n_selected]] = True
+
+        first = 0
+        with open(output_path, 'wb') as output_file:
+            for buf, line_ends in self.iter_fastq_records(console, fastq_path):
+                last = first + len(line_ends)
+                self.write_fastq_records(output_file, buf, line_ends, keep[first:last])
+                first = last
+
+        n_reads_short = len(lengths) - len(eligible)
+        kept_length = int(lengths[keep].sum())
+        self.log(console, 'subsampled long reads: kept '+str(n_selected)+' of '+str(len(lengths)) +
+                 ' reads, '+str(kept_length)+' of '+str(int(lengths.sum()))+' bases')
+        return [len(lengths), n_reads_short, n_selected, kept_length]
+
+    # open a file to write reads to, gzipped if its name ends in .gz
+    def open_reads_output(self, path):
+        if not path.endswith('.gz'):
+            return open(path, 'wb', buffering=self.SCAN_CHUNK_SIZE)
+        if igzip_threaded is not None:
+            return igzip_threaded.open(path, 'wb', compresslevel=self.COMBINED_READS_COMPRESSLEVEL,
+                                       threads=self.detect_cpus())
+        return gzip.open(path, 'wb', compresslevel=self.COMBINED_READS_COMPRESSLEVEL)
+
+    # read forward and reverse fastq files in step, yielding batches of at
+    # most batch_size pairs.  For each file a batch is the chunk buffer, the
+    # line ends of the batch's records, and where its first record starts.
+    def iter_fastq_pairs(self, console, fwd_path, rev_path, batch_size):
+        chunks = [self.iter_fastq_records(console, fwd_path),
+                  self.iter_fastq_records(console, rev_path)]
+        current = [None, None]  # [buf, line_ends, next record] for each file
+        while True:
+            for i in range(2):
+                if current[i] is None or current[i][2] == len(current[i][1]):
+                    chunk = next(chunks[i], None)
+                    current[i] = None if chunk is None else [chunk[0], chunk[1], 0]
+            if current[0] is None or current[1] is None:
+                if current[0] is not None or current[1] is not None:
+                    raise ValueError('Forward and reverse reads files '+fwd_path+' and '+rev_path +
+                                     ' have different numbers of reads')
+                return
+            n = min(len(current[0][1]) - current[0][2], len(current[1][1]) - current[1][2],
+                    batch_size)
+            batch = []
+            for buf, line_ends, first in current:
+                start = line_ends[first - 1, 3] + 1 if first > 0 else 0
+                batch.extend([buf, line_ends[first:first + n], start])
+            yield batch
+            for i in range(2):
+                current[i][2] += n
+
+    # canonical k-mers (the smaller of a k-mer and its reverse complement,
+    # two bits per base) of the sequences of fastq records, with the index of
+    # the record each came from.  k-mers with bases other than ACGT are skipped.
+    def fastq_kmers(self, buf, line_ends, k):
+        codes = np.full(256, 4, dtype=np.uint8)
+        for code, bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+            codes[list(bases)] = code
+
+        # the sequences of all records, one after the other
+        data = np.frombuffer(buf, dtype=np.uint8)
+        seq_lengths = self.fastq_seq_lengths(buf, line_ends)
+        record = np.repeat(np.arange(len(seq_lengths)), seq_lengths)
+        seq_offsets = np.cumsum(seq_lengths) - seq_lengths
+        positions = np.arange(len(record)) - seq_offsets[record] + line_ends[record, 0] + 1
+        seq = codes[data[positions]]
+
+        n_kmers = len(seq) - k + 1
+        if n_kmers <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+        # a k-mer is valid if it lies within one record and is all ACGT
+        n_invalid = np.concatenate(([0], np.cumsum(seq > 3)))
+        valid = (record[:n_kmers] == record[k - 1:]) & (n_invalid[k:] == n_invalid[:n_kmers])
+
+        # values of the windows of w bases at each position, forward and
+        # reverse complement, built by doubling w; the k-mers are put
+        # together from the windows for the bits of k
+        forward_w = np.minimum(seq, 3).astype(np.uint64)
+        reverse_w = np.uint64(3) - forward_w
+        forward = reverse = None
+        w = 1
+        n_bases = 0  # in the k-mers so far
+        while True:
+            if k & w:
+                if forward is None:
+                    forward, reverse = forward_w, reverse_w
+                else:
+                    n = len(seq) - n_bases - w + 1
+                    forward = (forward[:n] << np.uint64(2 * w)) | forward_w[n_bases:n_bases + n]
+                    reverse = reverse[:n] | (reverse_w[n_bases:n_bases + n] << np.uint64(2 * n_bases))
+                n_bases += w
+            if 2 * w > k:
+                break
+            n = len(forward_w) - w
+            forward_w = (forward_w[:n] << np.uint64(2 * w)) | forward_w[w:w + n]
+            reverse_w = reverse_w[:n] | (reverse_w[w:w + n] << np.uint64(2 * w))
+            w *= 2
+        return record[:n_kmers][valid], np.minimum(forward, reverse)[valid]
+
+    # digital normalization of one pair of forward and reverse reads files,
+    # appending the kept pairs to fwd_out and rev_out.  A pair is kept if the
+    # median count of its k-mers, in the pairs kept so far, is below
+    # target_depth; this thins out high coverage regions to about target_depth
+    # while leaving low coverage ones alone.  The counts are kept in sketch, a
+    # count-min sketch of uint8 counters.  Pairs are judged a batch at a time;
+    # within a batch, earlier pairs' k-mers count whether or not they are
+    # kept.  Returns the number of pairs read and kept.
+    def normalize_pairs(self, console, sketch, target_depth, fwd_path, rev_path,
+                        fwd_out, rev_out):
+        shift = np.uint64(64 - self.NORMALIZE_SKETCH_BITS)
+        multipliers = [np.uint64(m) for m in self.NORMALIZE_HASH_MULTIPLIERS[:len(sketch)]]
+        n_pairs = 0
+        n_pairs_kept = 0
+        for fwd_buf, fwd_ends, fwd_start, rev_buf, rev_ends, rev_start in self.iter_fastq_pairs(
+                console, fwd_path, rev_path, self.NORMALIZE_BATCH_PAIRS):
+            n = len(fwd_ends)
+            fwd_pair, fwd_kmers = self.fastq_kmers(fwd_buf, fwd_ends, self.NORMALIZE_KMER_SIZE)
+            rev_pair, rev_kmers = self.fastq_kmers(rev_buf, rev_ends, self.NORMALIZE_KMER_SIZE)
+            pair = np.concatenate((fwd_pair, rev_pair))
+            kmers = np.concatenate((fwd_kmers, rev_kmers))
+            # order of the k-mers in the reads: by pair, forward read first
+            n_fwd = np.bincount(fwd_pair, minlength=n)
+            n_rev = np.bincount(rev_pair, minlength=n)
+            pair_starts = np.cumsum(n_fwd + n_rev) - n_fwd - n_rev
+            arrival = np.concatenate((
+                np.arange(len(fwd_pair)) - (np.cumsum(n_fwd) - n_fwd)[fwd_pair] +
+                pair_starts[fwd_pair],
+                np.arange(len(rev_pair)) - (np.cumsum(n_rev) - n_rev)[rev_pair] +
+                pair_starts[rev_pair] + n_fwd[rev_pair]))
+
+            # estimated count of each k-mer: the smallest of its counters,
+            # plus the times it was seen earlier in the batch
+            counts = None
+            for row, multiplier in enumerate(multipliers):
+                row_counts = sketch[row][(kmers * multiplier) >> shift]
+                counts = row_counts if counts is None else np.minimum(counts, row_counts)
+            bits = max(len(kmers), 1).bit_length()
+            if 2 * self.NORMALIZE_KMER_SIZE + bits <= 64:
+                # sorting k-mer and arrival packed into one integer is much
+                # faster than lexsort
+                keys = np.sort((kmers << np.uint64(bits)) | arrival.astype(np.uint64))
+                sorted_kmers = keys >> np.uint64(bits)
+                sorted_arrival = (keys & np.uint64((1 << bits) - 1)).astype(np.int64)
+            else:
+                order = np.lexsort((arrival, kmers))
+                sorted_kmers = kmers[order]
+                sorted_arrival = arrival[order]
+            run_starts = np.flatnonzero(np.concatenate(
+                ([True], sorted_kmers[1:] != sorted_kmers[:-1])))
+            run_lengths = np.diff(np.append(run_starts, len(kmers)))
+            earlier = np.empty(len(kmers), dtype=np.int64)
+            earlier[sorted_arrival] = np.arange(len(kmers)) - np.repeat(run_starts, run_lengths)
+            counts = np.minimum(counts + earlier[arrival], 255)
+
+            # median count of each pair's k-mers, from the k-mers sorted by
+            # pair and then count; pairs without k-mers are kept
+            n_pair_kmers = np.bincount(pair, minlength=n)
+            keys = np.sort(pair * 256 + counts)
+            medians = np.zeros(n, dtype=np.int64)
+            has_kmers = n_pair_kmers > 0
+            middle = np.cumsum(n_pair_kmers) - n_pair_kmers + n_pair_kmers // 2
+            medians[has_kmers] = keys[middle[has_kmers]] & 255
+            keep = medians < target_depth
+
+            # count the k-mers of the kept pairs, saturating at 255
+            kept_kmers = kmers[keep[pair]]
+            for row, multiplier in enumerate(multipliers):
+                slots, added = np.unique((kept_kmers * multiplier) >> shift, return_counts=True)
+                sketch[row, slots] = np.minimum(sketch[row, slots] + added, 255)
+
+            if keep.any():
+                self.write_fastq_records(fwd_out, fwd_buf, fwd_ends, keep, fwd_start)
+                self.write_fastq_records(rev_out, rev_buf, rev_ends, keep, rev_start)
+            n_pairs += n
+            n_pairs_kept += int(np.count_nonzero(keep))
+        self.log(console, 'normalized '+fwd_path+' and '+rev_path+': kept '+str(n_pairs_kept) +
+                 ' of '+str(n_pairs)+' pairs')
+        return [n_pairs, n_pairs_kept]
+
+    # normalize the downloaded short paired libraries to target_depth, writing
+    # the kept pairs to the combined forward and reverse reads files.  All
+    # libraries share one sketch, so depth is counted across libraries.
+    def normalize_short_paired(self, console, result, reads_refs, target_depth,
+                               short_fwd_path, short_rev_path):
+        sketch = np.zeros((self.NORMALIZE_SKETCH_ROWS, 2 ** self.NORMALIZE_SKETCH_BITS),
+                          dtype=np.uint8)
+        n_pairs = 0
+        n_pairs_kept = 0
+        with self.open_reads_output(short_fwd_path) as fwd_out, \
+                self.open_reads_output(short_rev_path) as rev_out:
+            for reads_ref in reads_refs:
+                files = result['files'][reads_ref]['files']
+                if 'fwd' not in files or 'rev' not in files:
+                    raise ValueError('File '+reads_ref+' missing forward or reverse reads file')
+                [lib_pairs, lib_pairs_kept] = self.normalize_pairs(
+                    console, sketch, target_depth, files['fwd'], files['rev'], fwd_out, rev_out)
+                n_pairs += lib_pairs
+                n_pairs_kept += lib_pairs_kept
+                os.remove(files['fwd'])
+                os.remove(files['rev'])
+        return [n_pairs, n_pairs_kept]
+
+    # estimate the reads and bases of a fastq file.  k-mers are taken from
+    # the first sample_bases bases of reads; of those, the ones whose hash has
+    # its top ESTIMATE_KMER_SAMPLE_BITS bits zero are appended to kmer_samples,
+    # so each sampled k-mer keeps all its occurrences.  The file is read no
+    # further than that, or than ESTIMATE_MIN_SCAN_BASES: the counts are
+    # extrapolated from the part read by its size.  Returns the numbers of
+    # reads and of bases, and how many bases k-mers were taken from.
+    def scan_reads_for_estimate(self, console, fastq_path, sample_bases, kmer_samples):
+        multiplier = np.uint64(self.NORMALIZE_HASH_MULTIPLIERS[0])
+        shift = np.uint64(64 - self.ESTIMATE_KMER_SAMPLE_BITS)
+        n_reads = 0
+        n_bases = 0
+        sampled_bases = 0
+        stopped = False
+        raw_position = [0]
+        for buf, line_ends in self.iter_fastq_records(console, fastq_path, raw_position):
+            seq_lengths = self.fastq_seq_lengths(buf, line_ends)
+            if sampled_bases < sample_bases:
+                kmers = self.fastq_kmers(buf, line_ends, self.ESTIMATE_KMER_SIZE)[1]
+                kmer_samples.append(kmers[((kmers * multiplier) >> shift) == 0])
+                sampled_bases += int(seq_lengths.sum())
+            n_reads += len(seq_lengths)
+            n_bases += int(seq_lengths.sum())
+            if n_bases >= max(sample_bases, self.ESTIMATE_MIN_SCAN_BASES):
+                stopped = True
+                break
+        file_size = os.path.getsize(fastq_path)
+        if stopped and 0 < raw_position[0] < file_size:
+            scale = file_size / float(raw_position[0])
+            n_reads = int(n_reads * scale)
+            n_bases = int(n_bases * scale)
+        return [n_reads, n_bases, sampled_bases]
+
+    # estimate the genome size from the spectrum of sampled k-mers: k-mers
+    # with errors make a falling curve at low counts, followed by a peak from
+    # the genome's k-mers, so the k-mers counted at least as often as the
+    # first minimum are taken to be genomic.  Returns None if there is no
+    # such minimum, e.g. if the sample is too shallow.
+    def estimate_genome_size(self, console, kmer_samples):
+        kmers = np.concatenate(kmer_samples) if kmer_samples else np.zeros(0, dtype=np.uint64)
+        if len(kmers) == 0:
+            return None
+        counts = np.unique(kmers, return_counts=True)[1]
+        spectrum = np.bincount(counts)
+        rising = np.flatnonzero(spectrum[2:] > spectrum[1:-1])
+        if len(rising) == 0:
+            self.log(console, 'k-mer spectrum has no coverage peak; genome size not estimated')
+            return None
+        cutoff = int(rising[0]) + 1
+        peak = cutoff + int(np.argmax(spectrum[cutoff:]))
+        genome_size = int(spectrum[cutoff:].sum()) << self.ESTIMATE_KMER_SAMPLE_BITS
+        self.log(console, 'k-mer spectrum: error cutoff '+str(cutoff)+', peak at '+str(peak) +
+                 '; estimated genome size '+str(genome_size)+' bp')
+        return genome_size
+
+    # estimate the genome size and the depth of the short and long reads, and
+    # predict how long the assembly will take.  Short reads files are scanned
+    # once; the long reads were counted when they were filtered.
+    def estimate_coverage(self, console, read_stats, short_paths, long_path):
+        kmer_samples = []
+        sample_bases = self.ESTIMATE_SAMPLE_BASES
+        short_bases = 0
+        for path in short_paths:
+            [n_reads, n_bases, sampled_bases] = self.scan_reads_for_estimate(
+                console, path, sample_bases, kmer_samples)
+            self.log(console, path+': about '+str(n_reads)+' reads, '+str(n_bases)+' bases')
+            short_bases += n_bases
+            sample_bases -= sampled_bases
+        long_bases = 0
+        if long_path is not None:
+            if 'long' in read_stats:
+                long_bases = read_stats['long']['total_length']
+                if not short_paths:
+                    # no short reads; long reads with few errors still give a peak
+                    self.scan_reads_for_estimate(console, long_path, sample_bases, kmer_samples)
+            else:
+                long_bases = self.estimate_bases(long_path)
+
+        genome_size = self.estimate_genome_size(console, kmer_samples)
+        coverage = {'genome_size': genome_size,
+                    'short_bases': short_bases,
+                    'long_bases': long_bases,
+                    'short_depth': short_bases / float(genome_size) if genome_size else None,
+                    'long_depth': long_bases / float(genome_size) if genome_size else None}
+        if genome_size:
+            self.log(console, 'Estimated depth: short reads {:.1f}x, long reads {:.1f}x'.format(
+                coverage['short_depth'], coverage['long_depth']))
+
+        input_gbases = (short_bases + long_bases) / 1e9
+        for max_gbases, runtime_class in self.RUNTIME_CLASSES:
+            if input_gbases < max_gbases:
+                break
+        coverage['runtime_class'] = runtime_class
+        self.log(console, 'Predicted runtime class: {} for {:.2f} Gbases of input'.format(
+            runtime_class, input_gbases))
+        read_stats['coverage'] = coverage
+        return coverage
+
+    # write a random fraction of the reads of a fastq file, or of the pairs
+    # of forward and reverse fastq files, to new files.  Returns their paths.
+    def downsample_fastq(self, console, paths, fraction):
+        output_paths = [os.path.join(self.scratch, 'downsampled_'+str(uuid.uuid4()) +
+                                     ('.fastq.gz' if path.endswith('.gz') else '.fastq'))
+                        for path in paths]
+        if len(paths) == 2:
+            batches = ((batch[0:3], batch[3:6]) for batch in self.iter_fastq_pairs(
+                console, paths[0], paths[1], self.NORMALIZE_BATCH_PAIRS))
+        else:
+            batches = (((buf, line_ends, 0),)
+                       for buf, line_ends in self.iter_fastq_records(console, paths[0]))
+        rng = np.random.default_rng(0)
+        output_files = [self.open_reads_output(path) for path in output_paths]
+        try:
+            for batch in batches:
+                keep = rng.random(len(batch[0][1])) < fraction
+                if keep.any():
+                    for output_file, (buf, line_ends, start) in zip(output_files, batch):
+                        self.write_fastq_records(output_file, buf, line_ends, keep, start)
+        finally:
+            for output_file in output_files:
+                output_file.close()
+        for path in paths:
+            os.remove(path)
+        self.log(console, 'downsampled '+', '.join(paths)+' to '+', '.join(output_paths) +
+                 ' keeping {:.1%} of reads'.format(fraction))
+        return output_paths
+
+    # downsample the short and the long reads to max_depth, if they are deeper
+    # than that.  Short reads are sampled at random, pairs kept together; long
+    # reads are subsampled keeping the best ones.  Returns the new paths.
+    def limit_depth(self, console, read_stats, coverage, max_depth, short_paired_paths,
+                    short_unpaired_paths, long_path):
+        if not coverage['genome_size']:
+            self.log(console, 'Warning: genome size unknown, so reads were not downsampled')
+            return short_paired_paths, short_unpaired_paths, long_path
+        if coverage['short_depth'] > max_depth:
+            fraction = max_depth / coverage['short_depth']
+            self.log(console, 'Downsampling short reads from {:.1f}x to {}x'.format(
+                coverage['short_depth'], max_depth))
+            if short_paired_paths:
+                short_paired_paths = self.downsample_fastq(console, short_paired_paths, fraction)
+            short_unpaired_paths = [self.downsample_fastq(console, [path], fraction)[0]
+                                    for path in short_unpaired_paths]
+            read_stats['coverage']['short_downsampled_depth'] = max_depth
+        if coverage['long_depth'] > max_depth and 'long' in read_stats:
+            self.log(console, 'Downsampling long reads from {:.1f}x to {}x'.format(
+                coverage['long_depth'], max_depth))
+            subsampled_path = os.path.join(self.scratch, 'long_subsampled_'+str(uuid.uuid4()) +
+                                           '.fastq')
+            self.subsample_fastq(console, long_path, 0, max_depth * coverage['genome_size'],
+                                 subsampled_path)
+            os.remove(long_path)
+            long_path = subsampled_path
+            read_stats['coverage']['long_downsampled_depth'] = max_depth
+        return short_paired_paths, short_unpaired_paths, long_path
+
+    # split a unicycler fasta header (without the '>') into the contig id,
+    # depth and whether the contig is circular, as the report always has
+    def parse_contig_header(self, fasta_header):
+        try:
+            fields = fasta_header.strip().split(' ')
+            contig_id = fields[0]
+            depth = float(fields[2][6:-1]) if (fields[2].startswith('depth=')) else 0.0
+            circular = (len(fields) > 3) and ('circular=true' in fields[3])
+        except (IndexError, ValueError):
+            return fasta_header.strip(), 0.0, False
+        return contig_id, depth, circular
+
+    # parse a list of fasta headers (without the '>') as parse_contig_header
+    # does.  Unicycler's own headers are matched by one regular expression
+    # over all of them; other ones are parsed one by one.
+    def parse_contig_headers(self, headers):
+        if not headers:
+            return []
+        parsed = []
+        for contig_id, depth, circular, other_header in \
+                self.CONTIG_HEADER_PATTERN.findall(b'\n'.join(headers).decode()):
+            if contig_id:
+                parsed.append((contig_id, float(depth), bool(circular)))
+            else:
+                parsed.append(self.parse_contig_header(other_header))
+        return parsed
+
+    def postprocess_assembly(self, console, fasta_path: Path):
         """
         Rewrite the fasta file so that the fasta header names aren't integers, which
-        causes some programs *cough*DRAM*cough* to choke.
-        
-        Assumes the fasta file is formatted correctly.
+        causes some programs *cough*DRAM*cough* to choke, and collect the contig stats
+        in the same pass.  Any sequence before the first header is copied as it is
+        and counted towards the first contig.
+
+        Returns the path of the rewritten file and a ContigTable of the contigs.
         """
         out = fasta_path.parent / f"{fasta_path.stem}.rewrite_headers{fasta_path.suffix}"
-        with open(fasta_path) as infile, open(out, "w") as outfile:
-            for l in infile:
-                if l.startswith(">"):
-                    l = "> contig_" + l[1:].lstrip()
-                outfile.write(l)
+        contig_ids = []
+        columns = {'length': [], 'depth': [], 'circular': [], 'gc': [], 'n': []}
+        leading = {'length': 0, 'gc': 0, 'n': 0}  # sequence before the first header
+        with open(out, 'wb') as outfile:
+            for buf, starts, ends, lengths, gc, n in self.iter_fasta_blocks(fasta_path,
+                                                                            base_counts=True):
+                # sequence continued from the previous block
+                for column, values in [('length', lengths), ('gc', gc), ('n', n)]:
+                    if columns['length']:
+                        columns[column][-1] += int(values[0])
+                    else:
+                        leading[column] += int(values[0])
+                columns['length'].extend(lengths[1:].tolist())
+                columns['gc'].extend(gc[1:].tolist())
+                columns['n'].extend(n[1:].tolist())
+
+                # copy the sequence as it is, rewriting only the headers
+                view = memoryview(buf)
+                pos = 0
+                headers = []
+                for start, end in zip(starts.tolist(), ends.tolist()):
+                    outfile.write(view[pos:start])
+                    l = b'> contig_' + buf[start + 1:end + 1].lstrip()
+                    outfile.write(l)
+                    headers.append(l[1:].rstrip(b'\n'))
+                    pos = end + 1
+                outfile.write(view[pos:])
+                view.release()
+                for contig_id, depth, circular in self.parse_contig_headers(headers):
+                    contig_ids.append(contig_id)
+                    columns['depth'].append(depth)
+                    columns['circular'].append(circular)
+        if not contig_ids:
+            raise Exception("There are no contigs in this file")
+        for column, value in leading.items():
+            columns[column][0] += value
         # could delete the original file here? leave it for debugging, should get cleaned up by
         # the job runner
-        return str(out)
+        self.log(console, 'rewrote '+str(fasta_path)+' to '+str(out)+': ' +
+                 str(len(contig_ids))+' contigs, '+str(sum(columns['length']))+' bp')
+        contig_table = ContigTable(contig_ids, columns['length'], columns['depth'],
+                                   columns['circular'], columns['gc'], columns['n'])
+        return str(out), contig_table
 
     #END_CLASS_HEADER
 
@@ -584,24 +2069,61 @@ A wrapper for the unicycler assembler
         Run Unicycler
         :param params: instance of type "UnicyclerParams" (To run Unicycler,
            you need at least one short read paired end library, and optional
-           unpaired reads (divided into short and long.  All reads of the
-           same time must be combined into a single file. workspace_name -
-           the name of the workspace from which to take input and store
-           output. output_contigset_name - the name of the output contigset
-           short_paired_libraries - a list of short, paired end reads
-           libraries short_unpaired_libraries - a list of short, paired end
-           reads libraries long_reads_libraries - a list of long reads
-           @optional min_contig_length @optional num_linear_seqs @optional
-           bridging_mode) -> structure: parameter "workspace_name" of String,
+           unpaired reads (divided into short and long.  All reads of the same
+           time must be combined into a single file. workspace_name - the name
+           of the workspace from which to take input and store output.
+           output_contigset_name - the name of the output contigset
+           short_paired_libraries - a list of short, paired end reads libraries
+           short_unpaired_libraries - a list of short, paired end reads
+           libraries long_reads_libraries - a list of long reads threads - the
+           number of threads for Unicycler and the tools it runs; by default,
+           all cpus available to the job are used download_threads - the
+           maximum number of reads libraries to download at the same time
+           (default 4) direct_reads_input - if 1 (the default), a single short
+           reads library is passed to Unicycler as downloaded instead of being
+           copied into a combined file, and several libraries that are all
+           gzipped are combined into one gzip file without decompressing them
+           compress_combined_reads - if 1 (the default), reads combined from
+           several libraries are written gzipped; gzipped input files are
+           appended without recompression long_read_target_bases - if set, the
+           long reads are subsampled to at most this many bases, keeping the
+           reads with the most expected correct bases (length times mean base
+           accuracy) target_depth - if set, the short paired end reads are
+           digitally normalized before assembly: a read pair is dropped if the
+           median count of its k-mers in the pairs kept so far is already
+           target_depth (1 to 254) max_depth - if set, the short and the long
+           reads are each downsampled to this depth if they are deeper, based
+           on a k-mer spectrum estimate of the genome size; short reads are
+           sampled at random, long reads keep the best ones quast_mode - how
+           the assembly metrics in the report are made: 'full' runs QUAST
+           (default), 'builtin' computes the metrics without running QUAST
+           zip_compresslevel - compression level of the zip file of the
+           output, 1 (fastest) to 9 (smallest), or 0 to store the files
+           uncompressed; default 6
+           output_tier - which of unicycler's output files are packaged in the
+           report's zip file: 'final' the assembly, its graph and the log,
+           'standard' all but the intermediate assembly graphs, 'full' all of
+           them (default) @optional min_contig_length @optional num_linear_seqs
+           @optional bridging_mode @optional threads @optional download_threads
+           @optional direct_reads_input @optional compress_combined_reads
+           @optional long_read_target_bases @optional target_depth @optional
+           max_depth @optional quast_mode @optional zip_compresslevel @optional
+           output_tier) -> structure: parameter "workspace_name" of String,
            parameter "output_contigset_name" of String, parameter
-           "short_paired_libraries" of list of type "paired_lib" (The
-           workspace object name of a PairedEndLibrary file, whether of the
-           KBaseAssembly or KBaseFile type.), parameter
-           "short_unpaired_libraries" of list of type "unpaired_lib" (The
-           workspace object name of a SingleEndLibrary file, whether of the
-           KBaseAssembly or KBaseFile type.), parameter "long_reads_library"
-           of String, parameter "min_contig_length" of Long, parameter
-           "num_linear_seqs" of Long, parameter "bridging_mode" of String
+           "short_paired_libraries" of list of type "paired_lib" (The workspace
+           object name of a PairedEndLibrary file, whether of the KBaseAssembly
+           or KBaseFile type.), parameter "short_unpaired_libraries" of list of
+           type "unpaired_lib" (The workspace object name of a SingleEndLibrary
+           file, whether of the KBaseAssembly or KBaseFile type.), parameter
+           "long_reads_library" of String, parameter "min_contig_length" of
+           Long, parameter "num_linear_seqs" of Long, parameter "bridging_mode"
+           of String, parameter "threads" of Long, parameter "download_threads"
+           of Long, parameter "direct_reads_input" of Long, parameter
+           "compress_combined_reads" of Long, parameter
+           "long_read_target_bases" of Long, parameter "target_depth" of Long,
+           parameter "max_depth" of Long, parameter "quast_mode" of String,
+           parameter "zip_compresslevel" of Long, parameter "output_tier" of
+           String
         :returns: instance of type "UnicyclerOutput" (Output parameters for
            Unicycler run. report_name - the name of the KBaseReport.Report
            workspace object. report_ref - the workspace reference of the
@@ -611,104 +2133,211 @@ A wrapper for the unicycler assembler
         # ctx is the context object
         # return variables are: output
         #BEGIN run_unicycler
-        console = []
-        warnings = []
-        self.log(console, 'Running run_unicycler with params:\n{}'.format(
-            json.dumps(params, indent=1)))
-        token = self.cfg['KB_AUTH_TOKEN']
-
-        # param checks
-        required_params = ['workspace_name',
-                           'output_contigset_name',
-                           'min_contig_length',
-                           'num_linear_seqs',
-                           'bridging_mode']
-        for required_param in required_params:
-            if required_param not in params or params[required_param] is None:
-                raise ValueError("Must define required param: '"+required_param+"'")
-
-        # needs either short paired or long
-        if ('short_paired_libraries' not in params or params['short_paired_libraries'] is None or len(params['short_paired_libraries']) == 0) and ('long_reads_library' not in params or params['long_reads_library'] is None):
-            raise ValueError("Must define either short_paired_libraries or long_reads_library")
-
-        # TODO this seems like it shouldn't be necessary, the system should handle provenence
-        #      for you, check into this. Not sure if the ctx provenance is even used
-        # load provenance
-        provenance = [{}]
-        if 'provenance' in ctx:
-            provenance = ctx['provenance']
-        if 'input_ws_objects' not in provenance[0]:
-            provenance[0]['input_ws_objects'] = []
-
-        if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None and len(params['short_paired_libraries']) > 0:
-            provenance[0]['input_ws_objects'].extend(params['short_paired_libraries'])
-        if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None and len(params['short_unpaired_libraries']) > 0:
-            provenance[0]['input_ws_objects'].extend(params['short_unpaired_libraries'])
-        if 'long_reads_library' in params and params['long_reads_library'] is not None:
-            provenance[0]['input_ws_objects'].append(params['long_reads_library'])
-
-        # build command line
-        cmd = 'unicycler'
-
-        # download, split, and recombine short paired libraries
-        if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None and len(params['short_paired_libraries']) > 0:
-            short1, short2 = self.download_short_paired(
-                console, token, params['workspace_name'], params['short_paired_libraries'])
-            cmd += ' -1 '+short1+' -2 '+short2
-
-        # download and combine short unpaired libraries
-        if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None and len(params['short_unpaired_libraries']) > 0:
-            unpaired = self.download_short_unpaired(
-                console, token, params['workspace_name'], params['short_unpaired_libraries'])
-            cmd += ' -s '+unpaired
-
-        # download long library
-        if 'long_reads_library' in params and params['long_reads_library'] is not None:
-            longLib = self.download_long(
-                console, warnings, token, params['workspace_name'], params['long_reads_library'], params['min_long_read_length'])
-            cmd += ' -l '+longLib
-
-        # other params
-        cmd += ' --min_fasta_length '+str(params['min_contig_length'])
-        cmd += ' --linear_seqs '+str(params['num_linear_seqs'])
-        cmd += ' --mode '+str(params['bridging_mode'])
-        cmd += ' --keep 0'
-
-        if ('no_correct' in params and (params['no_correct'] == 1)):
-            cmd += ' --no_correct'
-
-        # output directory
-        outputDir = os.path.join(self.scratch, "unicycler_"+str(uuid.uuid4()))
-        self.mkdir_p(outputDir)
-        cmd += ' -o '+outputDir
-
-        # run it
-        self.log(console, "command: "+cmd)
-        cmdProcess = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                      stderr=subprocess.STDOUT, shell=True)
-        for line in cmdProcess.stdout:
-            self.log(console, line.decode("utf-8").rstrip())
-        cmdProcess.wait()
-        if cmdProcess.returncode != 0:
-            raise ValueError('Error running '+cmd)
-
-        # save assembly
+        console = ConsoleLog(os.path.join(self.scratch,
+                                          'console_' + str(uuid.uuid4()) + '.log'),
+                             self.CONSOLE_TAIL_LINES)
         try:
-            contigsPath = os.path.join(outputDir, 'assembly.fasta')
-            contigsPath = self._rewrite_headers(Path(contigsPath))
-            auClient = AssemblyUtil(url=self.callbackURL, token=token, service_ver='release')
-            auClient.save_assembly_from_fasta(
-                {'file': {'path': contigsPath},
-                 'workspace_name': params['workspace_name'],
-                 'assembly_name': params['output_contigset_name']})
-        except Exception as e:
-            raise ValueError('Error saving assembly\n' + str(e))
-
-        # make report
-        report_name, report_ref = self.generate_report(
-            console, warnings, contigsPath, params, outputDir, params['workspace_name'])
-        output = {'report_name': report_name,
-                  'report_ref': report_ref}
+            warnings = []
+            read_stats = dict()
+            self.log(console, 'Running run_unicycler with params:\n{}'.format(
+                json.dumps(params, indent=1)))
+            token = self.cfg['KB_AUTH_TOKEN']
+
+            # param checks
+            required_params = ['workspace_name',
+                               'output_contigset_name',
+                               'min_contig_length',
+                               'num_linear_seqs',
+                               'bridging_mode']
+            for required_param in required_params:
+                if required_param not in params or params[required_param] is None:
+                    raise ValueError("Must define required param: '"+required_param+"'")
+
+            # needs either short paired or long
+            if ('short_paired_libraries' not in params or params['short_paired_libraries'] is None or len(params['short_paired_libraries']) == 0) and ('long_reads_library' not in params or params['long_reads_library'] is None):
+                raise ValueError("Must define either short_paired_libraries or long_reads_library")
+
+            # a long read target over the limit would only fail after downloading
+            if params.get('long_read_target_bases'):
+                params['long_read_target_bases'] = int(params['long_read_target_bases'])
+                if not 0 < params['long_read_target_bases'] <= self.MAX_LONG_READ_BASES:
+                    raise ValueError('long_read_target_bases must be between 1 and ' +
+                                     str(self.MAX_LONG_READ_BASES))
+            target_depth = int(params['target_depth']) if params.get('target_depth') else None
+            if target_depth is not None and not 0 < target_depth < 255:
+                raise ValueError('target_depth must be between 1 and 254')
+            max_depth = int(params['max_depth']) if params.get('max_depth') else None
+            if max_depth is not None and max_depth < 1:
+                raise ValueError('max_depth must be at least 1')
+            if params.get('zip_compresslevel') in ('', None):
+                params['zip_compresslevel'] = None
+            else:
+                params['zip_compresslevel'] = int(params['zip_compresslevel'])
+                if not 0 <= params['zip_compresslevel'] <= 9:
+                    raise ValueError('zip_compresslevel must be between 0 and 9')
+            if (params.get('output_tier') or 'full') not in self.OUTPUT_TIERS:
+                raise ValueError('output_tier must be one of: ' + ', '.join(self.OUTPUT_TIERS))
+            quast_mode = params.get('quast_mode') or 'full'
+            if quast_mode not in self.QUAST_MODES:
+                raise ValueError('quast_mode must be one of: ' + ', '.join(self.QUAST_MODES))
+
+            # TODO this seems like it shouldn't be necessary, the system should handle provenence
+            #      for you, check into this. Not sure if the ctx provenance is even used
+            # load provenance
+            provenance = [{}]
+            if 'provenance' in ctx:
+                provenance = ctx['provenance']
+            if 'input_ws_objects' not in provenance[0]:
+                provenance[0]['input_ws_objects'] = []
+
+            if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None and len(params['short_paired_libraries']) > 0:
+                provenance[0]['input_ws_objects'].extend(params['short_paired_libraries'])
+            if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None and len(params['short_unpaired_libraries']) > 0:
+                provenance[0]['input_ws_objects'].extend(params['short_unpaired_libraries'])
+            if 'long_reads_library' in params and params['long_reads_library'] is not None:
+                provenance[0]['input_ws_objects'].append(params['long_reads_library'])
+
+            # build command line
+            cmd = 'unicycler'
+            input_paths = []
+
+            # download the short paired, short unpaired and long libraries
+            # concurrently; at most download_threads transfers run at once
+            libraries = []
+            if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None:
+                libraries.extend(params['short_paired_libraries'])
+            if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None:
+                libraries.extend(params['short_unpaired_libraries'])
+            if 'long_reads_library' in params and params['long_reads_library'] is not None:
+                libraries.append(params['long_reads_library'])
+            lib_infos = self.resolve_library_refs(console, token, params['workspace_name'], libraries)
+
+            if 'long_reads_library' in params and params['long_reads_library'] is not None:
+                self.check_long_reads_size(console, lib_infos[params['long_reads_library']],
+                                           params.get('long_read_target_bases'),
+                                           params.get('min_long_read_length'))
+
+            download_threads = int(params.get('download_threads') or self.DEFAULT_DOWNLOAD_THREADS)
+            set_items = self.expand_reads_sets(console, token, lib_infos, download_threads)
+            direct_input = params.get('direct_reads_input') != 0
+            compress = params.get('compress_combined_reads') != 0
+
+            download_slots = threading.BoundedSemaphore(download_threads)
+            downloads = dict()
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                # download, split, and recombine short paired libraries
+                if 'short_paired_libraries' in params and params['short_paired_libraries'] is not None and len(params['short_paired_libraries']) > 0:
+                    downloads['short_paired'] = executor.submit(
+                        self.download_short_paired, console, read_stats, token,
+                        self.get_reads_refs(console, params['short_paired_libraries'],
+                                            lib_infos, set_items),
+                        download_slots, direct_input, compress, target_depth)
+
+                # download and combine short unpaired libraries
+                if 'short_unpaired_libraries' in params and params['short_unpaired_libraries'] is not None and len(params['short_unpaired_libraries']) > 0:
+                    downloads['short_unpaired'] = executor.submit(
+                        self.download_short_unpaired, console, token,
+                        self.get_reads_refs(console, params['short_unpaired_libraries'],
+                                            lib_infos, set_items),
+                        download_slots, direct_input, compress)
+
+                # download long library
+                if 'long_reads_library' in params and params['long_reads_library'] is not None:
+                    downloads['long'] = executor.submit(
+                        self.download_long, console, warnings, read_stats, token,
+                        params['long_reads_library'], lib_infos, params['min_long_read_length'],
+                        params.get('long_read_target_bases'), download_slots)
+
+            download_errors = [str(f.exception()) for f in downloads.values()
+                               if f.exception() is not None]
+            if download_errors:
+                raise ValueError('\n'.join(download_errors))
+
+            short_paired_paths = list(downloads['short_paired'].result()) \
+                if 'short_paired' in downloads else []
+            short_unpaired_paths = [downloads['short_unpaired'].result()] \
+                if 'short_unpaired' in downloads else []
+            longLib = downloads['long'].result() if 'long' in downloads else None
+
+            # estimate genome size and depth, and downsample reads that are
+            # deeper than max_depth
+            coverage = self.estimate_coverage(console, read_stats,
+                                              short_paired_paths + short_unpaired_paths, longLib)
+            if max_depth is not None:
+                short_paired_paths, short_unpaired_paths, longLib = self.limit_depth(
+                    console, read_stats, coverage, max_depth, short_paired_paths,
+                    short_unpaired_paths, longLib)
+
+            if short_paired_paths:
+                short1, short2 = short_paired_paths
+                cmd += ' -1 '+short1+' -2 '+short2
+                input_paths.extend([short1, short2])
+            if short_unpaired_paths:
+                unpaired = short_unpaired_paths[0]
+                cmd += ' -s '+unpaired
+                input_paths.append(unpaired)
+            if longLib is not None:
+                cmd += ' -l '+longLib
+                input_paths.append(longLib)
+
+            # other params
+            cmd += ' --min_fasta_length '+str(params['min_contig_length'])
+            cmd += ' --linear_seqs '+str(params['num_linear_seqs'])
+            cmd += ' --mode '+str(params['bridging_mode'])
+            cmd += ' --keep 0'
+            cmd += ' --threads '+str(self.plan_threads(console, params))
+
+            # memory limits for SPAdes and Pilon; the pilon wrapper script reads
+            # its heap size from the environment
+            memory_plan = self.plan_memory(console, input_paths)
+            cmd += ' --spades_options "-m '+str(memory_plan['spades_gb'])+'"'
+            env = dict(os.environ, PILON_MAX_HEAP=str(memory_plan['pilon_gb'])+'G')
+
+            if ('no_correct' in params and (params['no_correct'] == 1)):
+                cmd += ' --no_correct'
+
+            # output directory
+            outputDir = os.path.join(self.scratch, "unicycler_"+str(uuid.uuid4()))
+            self.mkdir_p(outputDir)
+            cmd += ' -o '+outputDir
+
+            # run it
+            self.log(console, "command: "+cmd)
+            cmdProcess = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT, shell=True, env=env)
+            stage_timer = StageTimer(self.STAGE_KEYWORDS, self.STAGE_END_HEADER)
+            sampler = ProcessSampler(cmdProcess.pid, os.path.join(outputDir, 'resource_usage.tsv'),
+                                     self.RESOURCE_SAMPLE_INTERVAL, stage_timer.add_rss)
+            sampler.start()
+            self.log_process_output(console, cmdProcess.stdout, stage_timer)
+            cmdProcess.wait()
+            sampler.stop()
+            stage_timer.stop()
+            stage_timer.write_json(os.path.join(outputDir, 'stage_timings.json'))
+            resources = sampler.summary()
+            if cmdProcess.returncode != 0:
+                raise ValueError('Error running '+cmd+'\n' +
+                                 '\n'.join(console.last(self.ERROR_CONTEXT_LINES)))
+
+            # save assembly, run QUAST and zip the output at the same time
+            try:
+                contigsPath = os.path.join(outputDir, 'assembly.fasta')
+                contigsPath, contig_table = self.postprocess_assembly(console, Path(contigsPath))
+            except Exception as e:
+                raise ValueError('Error saving assembly\n' + str(e))
+            genome_size = read_stats.get('coverage', {}).get('genome_size')
+            [quastret, output_files] = self.run_post_assembly(
+                console, token, params, contigsPath, contig_table, outputDir, quast_mode,
+                genome_size)
+
+            # make report
+            report_name, report_ref = self.generate_report(
+                console, warnings, read_stats, stage_timer.stages, resources, contig_table,
+                contigsPath, quastret, output_files, params, outputDir, params['workspace_name'])
+            output = {'report_name': report_name,
+                      'report_ref': report_ref}
+        finally:
+            console.close()
 
         #END run_unicycler
 
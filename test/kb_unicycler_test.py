@@ -228,9 +228,14 @@ class unicyclerTest(unittest.TestCase):
                       min_contig_length=100,
                       min_long_read_length=100,
                       num_linear_seqs=0,
-                      bridging_mode="normal"):
+                      bridging_mode="normal",
+                      long_read_target_bases=None,
+                      target_depth=None,
+                      quast_mode=None,
+                      output_tier=None):
         """
-        run_unicycler: The main method to test all possible input data sets
+        run_unicycler: The main method to test all possible input data sets;
+        expected_contigs of None accepts any number of contigs
         """
         test_name = inspect.stack()[1][3]
         print('\n**** starting expected success test: ' + test_name + ' *****')
@@ -249,11 +254,20 @@ class unicyclerTest(unittest.TestCase):
                   'min_long_read_length': min_long_read_length,
                   'num_linear_seqs': num_linear_seqs,
                   'bridging_mode': bridging_mode,
-                  'no_correct': 1
+                  'no_correct': 1,
+                  'long_read_target_bases': long_read_target_bases,
+                  'target_depth': target_depth,
+                  'quast_mode': quast_mode,
+                  'output_tier': output_tier
                   }
 
         ret = self.getImpl().run_unicycler(self.ctx, params)[0]
-        self.assertReportAssembly(ret, output_contigset_name, expected_contigs)
+        report = self.assertReportAssembly(ret, output_contigset_name, expected_contigs)
+        if long_read_target_bases:
+            self.assertIn('removed by subsampling', report['data']['text_message'])
+        if target_depth:
+            self.assertIn('normalized to depth ' + str(target_depth),
+                          report['data']['text_message'])
 
     def assertReportAssembly(self, ret_obj, assembly_name, expected_contigs):
         """
@@ -278,6 +292,8 @@ class unicyclerTest(unittest.TestCase):
         self.assertEqual(assembly_name, assembly['data']['assembly_id'])
         
         # check that contig names are correctly updated
+        if expected_contigs is None:
+            expected_contigs = len(assembly["data"]["contigs"])
         expected_contig_names = {f"contig_{c}" for c in range(1, expected_contigs + 1)}
         got_contig_names = set(assembly["data"]["contigs"].keys())
         self.assertEqual(expected_contig_names, got_contig_names)
@@ -285,6 +301,7 @@ class unicyclerTest(unittest.TestCase):
         temp_handle_info = self.hs.hids_to_handles([assembly['data']['fasta_handle_ref']])
         assembly_fasta_node = temp_handle_info[0]['id']
         self.nodes_to_delete.append(assembly_fasta_node)
+        return report
 
     # Uncomment to skip this test
     # @unittest.skip("skipped test test_shigella_short_kbfile")
@@ -320,4 +337,28 @@ class unicyclerTest(unittest.TestCase):
                             short_paired_libraries=['shigella_short'],
                             long_reads_library='shigella_assy')
 
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test test_shigella_short_builtin_quast_final")
+    def test_shigella_short_builtin_quast_final(self):
+        self.run_unicycler( 'shigella_short_builtin_out', 27,
+                            short_paired_libraries=['shigella_short'],
+                            quast_mode='builtin',
+                            output_tier='final')
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test test_shigella_short_target_depth")
+    def test_shigella_short_target_depth(self):
+        self.run_unicycler( 'shigella_short_normalized_out', None,
+                            short_paired_libraries=['shigella_short'],
+                            target_depth=20)
+
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test test_shigella_hybrid_long_target_bases")
+    def test_shigella_hybrid_long_target_bases(self):
+        # the low depth library has about 260 kbases of long reads
+        self.run_unicycler( 'shigella_hybrid_subsampled_out', None,
+                            short_paired_libraries=['shigella_short'],
+                            long_reads_library='shigella_long_low',
+                            long_read_target_bases=150000)
+
     # ########################End of passed tests######################
@@ -0,0 +1,586 @@
+from __future__ import print_function
+import unittest
+import gzip
+import io
+import os
+import random
+import re
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+
+from os import environ
+from pathlib import Path
+from unittest import mock
+
+from kb_unicycler.kb_unicyclerImpl import kb_unicycler, deflate_zip_member, ConsoleLog
+
+
+# filter_short_fastq as it was before it read in chunks, to check the new one
+# against; except that this doesn't count the line end in a read's length
+def reference_filter_short_fastq(fastq_path, min_length):
+    n_reads = 0
+    n_reads_short = 0
+    total_read_length = 0
+    with open(fastq_path, 'r') as input_file_handle:
+        for current_line in input_file_handle:
+            if (current_line[0] == '@'):
+                n_reads += 1
+                seq = next(input_file_handle).rstrip('\r\n')
+                if len(seq) < min_length:
+                    n_reads_short += 1
+                total_read_length += len(seq)
+                next(input_file_handle)
+                next(input_file_handle)
+    return [n_reads, n_reads_short, total_read_length]
+
+
+# load_stats, the fasta stats of the report before they were collected
+# while rewriting the headers
+def reference_load_stats(input_file_name):
+    with open(input_file_name, 'r') as input_file_handle:
+        contig_id = None
+        sequence_len = 0
+        length_dict = dict()
+        coverage_dict = dict()
+        circ_dict = dict()
+        first_header_found = False
+        # Pattern for replacing white space
+        pattern = re.compile(r'\s+')
+        for current_line in input_file_handle:
+            if (current_line[0] == '>'):
+                # found a header line
+                # Wrap up previous fasta sequence
+                if not first_header_found:
+                    first_header_found = True
+                else:
+                    length_dict[contig_id] = sequence_len
+                    sequence_len = 0
+                fasta_header = current_line.replace('>', '').strip()
+                try:
+                    fields = fasta_header.strip().split(' ')
+                    contig_id = fields[0]
+                    coverage = float(
+                        fields[2][6:-1]) if (fields[2].startswith('depth=')) else 0.0
+                    circ = 'Y' if ((len(fields) > 3) and (
+                        'circular=true' in fields[3])) else 'N'
+                    coverage_dict[contig_id] = coverage
+                    circ_dict[contig_id] = circ
+                except (IndexError, ValueError, KeyError):
+                    contig_id = fasta_header.strip()
+                    coverage_dict[contig_id] = 0
+                    circ_dict[contig_id] = 'N'
+            else:
+                sequence_len += len(re.sub(pattern, '', current_line))
+    length_dict[contig_id] = sequence_len
+    return [length_dict, coverage_dict, circ_dict]
+
+
+# canonical k-mers of a sequence, one window at a time, skipping windows with
+# bases other than ACGT
+def reference_kmers(seq, k):
+    codes = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+    kmers = []
+    for i in range(len(seq) - k + 1):
+        window = seq[i:i + k].upper()
+        if any(base not in codes for base in window):
+            continue
+        forward = 0
+        reverse = 0
+        for j, base in enumerate(window):
+            forward = forward * 4 + codes[base]
+            reverse += (3 - codes[base]) * 4 ** j
+        kmers.append(min(forward, reverse))
+    return kmers
+
+
+# which pairs normalize_pairs should keep, given the k-mers of each pair in
+# the order they are read and the number of pairs in each batch: a k-mer's
+# count is the times it was kept before the batch plus the times it was seen
+# earlier in the batch, and a pair is kept if its median count is below
+# target_depth
+def reference_normalize(pair_kmers, batch_sizes, target_depth):
+    kept_counts = dict()
+    keep = []
+    first = 0
+    for batch_size in batch_sizes:
+        batch = pair_kmers[first:first + batch_size]
+        seen = dict()
+        batch_keep = []
+        for kmers in batch:
+            counts = []
+            for kmer in kmers:
+                counts.append(min(kept_counts.get(kmer, 0) + seen.get(kmer, 0), 255))
+                seen[kmer] = seen.get(kmer, 0) + 1
+            batch_keep.append(not counts or sorted(counts)[len(counts) // 2] < target_depth)
+        for kmers, kept in zip(batch, batch_keep):
+            if kept:
+                for kmer in kmers:
+                    kept_counts[kmer] = min(kept_counts.get(kmer, 0) + 1, 255)
+        keep.extend(batch_keep)
+        first += batch_size
+    return keep
+
+
+class unicyclerUnitTest(unittest.TestCase):
+    """
+    Tests of the file handling in kb_unicyclerImpl that don't need the KBase
+    services: each works on small files it writes into a scratch directory.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scratch = tempfile.mkdtemp()
+        environ.setdefault('SDK_CALLBACK_URL', 'http://localhost')
+        environ.setdefault('KB_AUTH_TOKEN', '')
+        cls.serviceImpl = kb_unicycler({'service-wizard': '',
+                                        'workspace-url': '',
+                                        'shock-url': '',
+                                        'scratch': cls.scratch,
+                                        'appdir': os.path.join(os.path.dirname(__file__), '..')})
+        cls.random = random.Random(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.scratch)
+
+    def getImpl(self):
+        return self.serviceImpl
+
+    def write_file(self, path, data):
+        path = os.path.join(self.scratch, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def random_sequence(self, length):
+        return ''.join(self.random.choice('ACGT') for _ in range(length)).encode()
+
+    def random_fastq(self, n_reads, line_end=b'\n', lengths=(0, 10, 49, 50, 51, 300)):
+        records = []
+        for i in range(n_reads):
+            seq = self.random_sequence(self.random.choice(lengths))
+            records.append(b'@read' + str(i).encode() + line_end + seq + line_end + b'+' +
+                           line_end + b'I' * len(seq) + line_end)
+        return b''.join(records)
+
+    def test_filter_short_fastq(self):
+        impl = self.getImpl()
+        # chunks far smaller than the file, so records span chunk boundaries
+        with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 1000):
+            for line_end in [b'\n', b'\r\n']:
+                data = self.random_fastq(500, line_end)
+                path = self.write_file('filter.fastq', data)
+                expected = reference_filter_short_fastq(path, 50)
+                self.assertGreater(expected[1], 0)
+                gz_path = os.path.join(self.scratch, 'filter.fastq.gz')
+                with gzip.open(gz_path, 'wb') as f:
+                    f.write(data)
+                for input_path in [path, gz_path]:
+                    [n_reads, n_reads_short, total_read_length, short_read_length] = \
+                        impl.filter_short_fastq([], input_path, 50)
+                    self.assertEqual(expected, [n_reads, n_reads_short, total_read_length])
+
+    def test_check_long_reads_size(self):
+        impl = self.getImpl()
+
+        def lib_info(**meta):
+            return {'ref': '1/2/3', 'info': [None] * 10 + [meta]}
+
+        def check(meta, min_length, long_read_target_bases=None):
+            impl.check_long_reads_size([], meta, long_read_target_bases, min_length)
+
+        # 1.2 Gbases, but reads under 1000 bp could make up 0.3 Gbases of it
+        check(lib_info(total_bases='1200000000', read_count='300000'), 1000)
+        check(lib_info(read_count='300000', read_length_mean='4000'), 1000)
+        # ... or only 0.1 Gbases
+        with self.assertRaisesRegex(ValueError, 'at least 1100100000 B'):
+            check(lib_info(total_bases='1200000000', read_count='100000'), 1000)
+        # nothing is removed
+        with self.assertRaisesRegex(ValueError, 'Too many long reads'):
+            check(lib_info(total_bases='1200000000'), 0)
+        # too little metadata to tell, or the reads will be subsampled
+        check(lib_info(total_bases='1200000000'), 1000)
+        check(lib_info(), 0)
+        check(lib_info(total_bases='1200000000'), 0, 500000000)
+
+        # at the limit, the reads are accepted both before and after
+        # downloading when only the short ones take them over it
+        reads = b''.join(self.random_fastq(5, lengths=(20,)) + self.random_fastq(1, lengths=(100,))
+                         for i in range(10))
+        path = self.write_file('limit.fastq', reads)
+        with mock.patch.object(impl, 'MAX_LONG_READ_BASES', 1000):
+            check(lib_info(total_bases='2000', read_count='60'), 50)
+            [n_reads, n_reads_short, total_read_length, short_read_length] = \
+                impl.filter_short_fastq([], path, 50, None, impl.MAX_LONG_READ_BASES)
+            self.assertEqual([60, 50], [n_reads, n_reads_short])
+            self.assertEqual(1000, total_read_length - short_read_length)
+            with self.assertRaisesRegex(ValueError, 'Too many long reads'):
+                check(lib_info(total_bases='2000', read_count='60'), 0)
+
+    def test_filter_short_fastq_output(self):
+        impl = self.getImpl()
+        with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 1000):
+            for line_end in [b'\n', b'\r\n']:
+                data = self.random_fastq(500, line_end)
+                path = self.write_file('filter.fastq', data)
+                gz_path = os.path.join(self.scratch, 'filter.fastq.gz')
+                with gzip.open(gz_path, 'wb') as f:
+                    f.write(data)
+                kept = b''.join(record for record in re.findall(b'@[^@]*', data)
+                                if len(record.split(line_end)[1]) >= 50)
+                for input_path in [path, gz_path]:
+                    output_path = os.path.join(self.scratch, 'filtered.fastq')
+                    impl.filter_short_fastq([], input_path, 50, output_path)
+                    with open(output_path, 'rb') as f:
+                        self.assertEqual(kept, f.read())
+                    os.remove(output_path)
+
+            # with no short reads, no filtered copy is written
+            long_reads = self.random_fastq(100, lengths=(50, 300))
+            path = self.write_file('long.fastq', long_reads)
+            output_path = os.path.join(self.scratch, 'long_filtered.fastq')
+            self.assertEqual([100, 0], impl.filter_short_fastq([], path, 50, output_path)[:2])
+            self.assertFalse(os.path.exists(output_path))
+
+            # the reads before the first short one, chunks back, are copied
+            # once it is found
+            path = self.write_file('late_short.fastq', long_reads + b'@short\nA\n+\nI\n' +
+                                   long_reads)
+            self.assertEqual([201, 1], impl.filter_short_fastq([], path, 2, output_path)[:2])
+            with open(output_path, 'rb') as f:
+                self.assertEqual(long_reads + long_reads, f.read())
+
+    def test_zip_folder(self):
+        out_dir = os.path.join(self.scratch, 'zip_out')
+        graph = self.random_sequence(1000) * 2000  # over ZIP_POOL_MIN_SIZE
+        files = {'001_best_spades_graph.gfa': graph,
+                 'assembly.gfa': graph[::-1],
+                 'unicycler.log': b'log line\n' * 10,
+                 'reads.fastq.gz': b'\x1f\x8b' + self.random_sequence(100),
+                 os.path.join('sub', 'notes.txt'): b'notes\n'}
+        for name, data in files.items():
+            self.write_file(os.path.join('zip_out', name), data)
+        excluded = self.write_file(os.path.join('zip_out', 'assembly.fasta'), b'>1\nACGT\n')
+
+        output_path = os.path.join(self.scratch, 'zip_folder.zip')
+        [n_files, n_bytes] = self.getImpl().zip_folder(out_dir, output_path, [excluded], None, 2)
+        self.assertEqual(len(files), n_files)
+        self.assertEqual(sum(len(data) for data in files.values()), n_bytes)
+        with zipfile.ZipFile(output_path) as ziph:
+            self.assertIsNone(ziph.testzip())
+            names = {'zip_out/' + name if '/' not in name else name: data
+                     for name, data in files.items()}
+            self.assertEqual(set(names), set(ziph.namelist()))
+            for name, data in names.items():
+                self.assertEqual(data, ziph.read(name))
+            self.assertEqual(zipfile.ZIP_STORED,
+                             ziph.getinfo('zip_out/reads.fastq.gz').compress_type)
+            self.assertEqual(zipfile.ZIP_DEFLATED,
+                             ziph.getinfo('zip_out/assembly.gfa').compress_type)
+
+        # members can still be added afterwards, as the report does
+        with zipfile.ZipFile(output_path, 'a', zipfile.ZIP_DEFLATED) as ziph:
+            ziph.writestr('zip_out/quast_report.html', b'<html></html>')
+        with zipfile.ZipFile(output_path) as ziph:
+            self.assertIsNone(ziph.testzip())
+            self.assertEqual(len(files) + 1, len(ziph.namelist()))
+
+        # level 0 stores everything
+        self.getImpl().zip_folder(out_dir, output_path, [excluded], 0, 2)
+        with zipfile.ZipFile(output_path) as ziph:
+            self.assertIsNone(ziph.testzip())
+            self.assertEqual({zipfile.ZIP_STORED},
+                             {info.compress_type for info in ziph.infolist()})
+
+    def test_postprocess_assembly(self):
+        impl = self.getImpl()
+        headers = [b'>1 length=1000 depth=1.25x circular=true',
+                   b'>2 length=500 depth=10.00x',
+                   b'>3',
+                   b'>4 length=5 depth=bad',
+                   b'>5 length=0 depth=0.50x circular=false']
+        seqs = [self.random_sequence(self.random.randint(0, 5000)) for header in headers]
+        seqs[1] = seqs[1][:100] + b'NNNNnn' + seqs[1][100:]
+        # sequence before the first header counts towards the first contig
+        leading = b'ACGTN\n'
+        data = leading + b''.join(header + b'\n' +
+                                  b''.join(seq[i:i + 60] + b'\n' for i in range(0, len(seq), 60))
+                                  for header, seq in zip(headers, seqs))
+        expected_gc = [seq.count(b'G') + seq.count(b'C') for seq in seqs]
+        expected_gc[0] += 2
+        expected_n = [seq.upper().count(b'N') for seq in seqs]
+        expected_n[0] += 1
+        for line_end in [b'\n', b'\r\n']:
+            path = self.write_file(os.path.join('assembly_' + str(len(line_end)), 'assembly.fasta'),
+                                   data.replace(b'\n', line_end))
+            with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 1000):
+                contigs_path, contig_table = impl.postprocess_assembly([], Path(path))
+            with open(contigs_path, 'rb') as f:
+                self.assertEqual(data.replace(b'\n>', b'\n> contig_').replace(b'\n', line_end),
+                                 f.read())
+            [length_dict, coverage_dict, circ_dict] = reference_load_stats(contigs_path)
+            self.assertEqual(list(length_dict), contig_table.contig_ids)
+            self.assertEqual(list(length_dict.values()), contig_table.length.tolist())
+            self.assertEqual(list(coverage_dict.values()), contig_table.depth.tolist())
+            self.assertEqual([circ == 'Y' for circ in circ_dict.values()],
+                             contig_table.circular.tolist())
+            self.assertEqual(expected_gc, contig_table.gc.tolist())
+            self.assertEqual(expected_n, contig_table.n.tolist())
+
+    # reads from random positions on both strands of genome, with
+    # substitution errors at error_rate, as fastq
+    def simulate_reads(self, genome, n_reads, read_length, error_rate, seed=1):
+        rng = np.random.default_rng(seed)
+        genome = np.frombuffer(genome, dtype=np.uint8)
+        complement = np.zeros(256, dtype=np.uint8)
+        complement[list(b'ACGT')] = list(b'TGCA')
+        starts = rng.integers(0, len(genome) - read_length, n_reads)
+        reads = genome[starts[:, None] + np.arange(read_length)]
+        reverse = rng.random(n_reads) < 0.5
+        reads[reverse] = complement[reads[reverse, ::-1]]
+        errors = rng.random(reads.shape) < error_rate
+        reads[errors] = rng.choice(np.frombuffer(b'ACGT', dtype=np.uint8), int(errors.sum()))
+        quality = b'I' * read_length
+        return b''.join(b'@r' + str(i).encode() + b'\n' + read.tobytes() + b'\n+\n' + quality +
+                        b'\n' for i, read in enumerate(reads))
+
+    def test_estimate_coverage(self):
+        impl = self.getImpl()
+        genome_size = 200000
+        genome = self.random_sequence(genome_size)
+        # 30x of 150 bp reads with 0.5% errors
+        n_reads = 40000
+        path = self.write_file('estimate.fastq',
+                               self.simulate_reads(genome, n_reads, 150, 0.005))
+        read_stats = dict()
+        coverage = impl.estimate_coverage([], read_stats, [path], None)
+        self.assertAlmostEqual(genome_size, coverage['genome_size'], delta=genome_size * 0.1)
+        self.assertEqual(n_reads * 150, coverage['short_bases'])
+        self.assertAlmostEqual(30.0, coverage['short_depth'], delta=3.0)
+        self.assertIs(coverage, read_stats['coverage'])
+
+        # too shallow for a coverage peak
+        path = self.write_file('shallow.fastq', self.simulate_reads(genome, 200, 150, 0.005))
+        self.assertIsNone(impl.estimate_coverage([], dict(), [path], None)['genome_size'])
+
+    def test_scan_reads_for_estimate(self):
+        impl = self.getImpl()
+        data = self.simulate_reads(self.random_sequence(100000), 50000, 100, 0.01)
+        path = self.write_file('scan.fastq', data)
+        gz_path = os.path.join(self.scratch, 'scan.fastq.gz')
+        with gzip.open(gz_path, 'wb') as f:
+            f.write(data)
+        # the whole file, when it is under the limit
+        kmer_samples = []
+        self.assertEqual([50000, 5000000, 5000000],
+                         impl.scan_reads_for_estimate([], path, 10 ** 9, kmer_samples))
+        self.assertTrue(kmer_samples)
+
+        # counts extrapolated from the part read
+        with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 64 * 1024), \
+                mock.patch.object(impl, 'ESTIMATE_MIN_SCAN_BASES', 1000000):
+            for input_path in [path, gz_path]:
+                kmer_samples = []
+                [n_reads, n_bases, sampled_bases] = impl.scan_reads_for_estimate(
+                    [], input_path, 100000, kmer_samples)
+                self.assertAlmostEqual(50000, n_reads, delta=50000 * 0.05)
+                self.assertAlmostEqual(5000000, n_bases, delta=5000000 * 0.05)
+                self.assertGreaterEqual(sampled_bases, 100000)
+                self.assertLess(sampled_bases, 1000000)
+
+    def test_limit_depth(self):
+        impl = self.getImpl()
+        fwd = b''.join(b'@p' + str(i).encode() + b'/1\n' + self.random_sequence(50) +
+                       b'\n+\n' + b'I' * 50 + b'\n' for i in range(2000))
+        rev = b''.join(b'@p' + str(i).encode() + b'/2\n' + self.random_sequence(50) +
+                       b'\n+\n' + b'I' * 50 + b'\n' for i in range(2000))
+        fwd_path = self.write_file('deep_1.fastq', fwd)
+        rev_path = self.write_file('deep_2.fastq', rev)
+        read_stats = {'coverage': dict()}
+        coverage = {'genome_size': 10000, 'short_depth': 40.0, 'long_depth': 0.0}
+        with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 5000), \
+                mock.patch.object(impl, 'NORMALIZE_BATCH_PAIRS', 30):
+            [short_paired_paths, short_unpaired_paths, long_path] = impl.limit_depth(
+                [], read_stats, coverage, 10, [fwd_path, rev_path], [], None)
+        self.assertEqual(10, read_stats['coverage']['short_downsampled_depth'])
+        self.assertFalse(os.path.exists(fwd_path))
+        self.assertFalse(os.path.exists(rev_path))
+
+        # a quarter of the pairs are kept, in step and unchanged
+        fwd_kept = self.read_pairs(short_paired_paths[0])
+        rev_kept = self.read_pairs(short_paired_paths[1])
+        self.assertAlmostEqual(500, len(fwd_kept), delta=75)
+        self.assertEqual([name for name, seq in fwd_kept], [name for name, seq in rev_kept])
+        fwd_seqs = dict(self.read_pairs(self.write_file('deep_1.fastq', fwd)))
+        rev_seqs = dict(self.read_pairs(self.write_file('deep_2.fastq', rev)))
+        for (name, fwd_seq), (rev_name, rev_seq) in zip(fwd_kept, rev_kept):
+            self.assertEqual((fwd_seqs[name], rev_seqs[name]), (fwd_seq, rev_seq))
+
+        # reads no deeper than max_depth are left alone
+        self.assertEqual((short_paired_paths, [], None), impl.limit_depth(
+            [], read_stats, coverage, 50, short_paired_paths, [], None))
+
+    def read_pairs(self, path):
+        with open(path, 'rb') as f:
+            lines = f.read().decode().split('\n')
+        return [(lines[i][1:].split('/')[0], lines[i + 1]) for i in range(0, len(lines) - 1, 4)]
+
+    def test_fastq_kmers(self):
+        impl = self.getImpl()
+        seqs = [self.random_sequence(n).decode() for n in [0, 4, 5, 20, 21, 150]]
+        seqs += ['ACGTNACGTACGTACGTACGTACGTT', 'acgtaCGTACgtacgtacgtaGGGG']
+        for line_end in [b'\n', b'\r\n']:
+            data = b''.join(b'@r' + line_end + seq.encode() + line_end + b'+' + line_end +
+                            b'I' * len(seq) + line_end for seq in seqs)
+            line_ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10).reshape(-1, 4)
+            for k in [5, 20, 21]:
+                record, kmers = impl.fastq_kmers(data, line_ends, k)
+                expected = [(i, kmer) for i, seq in enumerate(seqs)
+                            for kmer in reference_kmers(seq, k)]
+                self.assertEqual(expected, list(zip(record.tolist(), kmers.tolist())))
+
+    def test_iter_fastq_pairs(self):
+        impl = self.getImpl()
+        fwd = b''.join(b'@p' + str(i).encode() + b'/1\n' + self.random_sequence(i % 97) +
+                       b'\n+\n' + b'I' * (i % 97) + b'\n' for i in range(300))
+        rev = b''.join(b'@p' + str(i).encode() + b'/2\n' + self.random_sequence(150) +
+                       b'\n+\n' + b'I' * 150 + b'\n' for i in range(300))
+        fwd_path = self.write_file('pairs_1.fastq', fwd)
+        rev_path = self.write_file('pairs_2.fastq', rev)
+        with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 1000):
+            n_pairs = 0
+            for fwd_buf, fwd_ends, fwd_start, rev_buf, rev_ends, rev_start in \
+                    impl.iter_fastq_pairs([], fwd_path, rev_path, 7):
+                self.assertEqual(len(fwd_ends), len(rev_ends))
+                self.assertLessEqual(len(fwd_ends), 7)
+                for i in range(len(fwd_ends)):
+                    fwd_name = fwd_buf[fwd_ends[i - 1, 3] + 1 if i else fwd_start:fwd_ends[i, 0]]
+                    rev_name = rev_buf[rev_ends[i - 1, 3] + 1 if i else rev_start:rev_ends[i, 0]]
+                    self.assertEqual(b'@p' + str(n_pairs).encode() + b'/1', fwd_name)
+                    self.assertEqual(b'@p' + str(n_pairs).encode() + b'/2', rev_name)
+                    n_pairs += 1
+            self.assertEqual(300, n_pairs)
+
+            rev_path = self.write_file('pairs_short_2.fastq', rev[:len(rev) // 2])
+            with self.assertRaisesRegex(ValueError, 'different numbers of reads'):
+                list(impl.iter_fastq_pairs([], fwd_path, rev_path, 7))
+
+    def test_normalize_pairs(self):
+        impl = self.getImpl()
+        complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+        genome = self.random_sequence(3000).decode()
+        # deep coverage of the genome, with a pair from unique sequence now
+        # and then, which should always be kept, and some reads with Ns
+        pairs = []
+        for i in range(400):
+            if i % 8 == 0:
+                pair = (self.random_sequence(100).decode(), self.random_sequence(100).decode())
+            else:
+                start = self.random.randint(0, len(genome) - 300)
+                pair = (genome[start:start + 100],
+                        ''.join(complement[b] for b in reversed(genome[start + 200:start + 300])))
+            if i % 50 == 1:
+                pair = (pair[0][:40] + 'N' + pair[0][41:], 'N' * 100)
+            pairs.append(pair)
+        fwd_path = self.write_file('normalize_1.fastq', ''.join(
+            '@p{}/1\n{}\n+\n{}\n'.format(i, fwd, 'I' * len(fwd))
+            for i, (fwd, rev) in enumerate(pairs)).encode())
+        rev_path = self.write_file('normalize_2.fastq', ''.join(
+            '@p{}/2\n{}\n+\n{}\n'.format(i, rev, 'I' * len(rev))
+            for i, (fwd, rev) in enumerate(pairs)).encode())
+        fwd_out_path = os.path.join(self.scratch, 'normalized_1.fastq')
+        rev_out_path = os.path.join(self.scratch, 'normalized_2.fastq')
+        target_depth = 5
+
+        with mock.patch.object(impl, 'SCAN_CHUNK_SIZE', 5000), \
+                mock.patch.object(impl, 'NORMALIZE_BATCH_PAIRS', 30), \
+                mock.patch.object(impl, 'NORMALIZE_SKETCH_BITS', 20):
+            batch_sizes = [len(batch[1]) for batch in
+                           impl.iter_fastq_pairs([], fwd_path, rev_path, 30)]
+            sketch = np.zeros((impl.NORMALIZE_SKETCH_ROWS, 2 ** 20), dtype=np.uint8)
+            with open(fwd_out_path, 'wb') as fwd_out, open(rev_out_path, 'wb') as rev_out:
+                [n_pairs, n_pairs_kept] = impl.normalize_pairs(
+                    [], sketch, target_depth, fwd_path, rev_path, fwd_out, rev_out)
+
+        pair_kmers = [reference_kmers(fwd, impl.NORMALIZE_KMER_SIZE) +
+                      reference_kmers(rev, impl.NORMALIZE_KMER_SIZE) for fwd, rev in pairs]
+        keep = reference_normalize(pair_kmers, batch_sizes, target_depth)
+        kept = ['p' + str(i) for i in range(len(pairs)) if keep[i]]
+        self.assertEqual(len(pairs), n_pairs)
+        self.assertEqual(len(kept), n_pairs_kept)
+        self.assertLess(n_pairs_kept, len(pairs) // 2)
+        self.assertTrue(all(keep[::8]))
+
+        # the kept pairs are written in step, each read as it was
+        fwd_kept = self.read_pairs(fwd_out_path)
+        rev_kept = self.read_pairs(rev_out_path)
+        self.assertEqual(kept, [name for name, seq in fwd_kept])
+        self.assertEqual(kept, [name for name, seq in rev_kept])
+        for (name, fwd_seq), (rev_name, rev_seq) in zip(fwd_kept, rev_kept):
+            self.assertEqual(pairs[int(name[1:])], (fwd_seq, rev_seq))
+
+    def test_run_unicycler_bad_params(self):
+        impl = self.getImpl()
+        params = {'workspace_name': 'ws', 'output_contigset_name': 'out',
+                  'min_contig_length': 100, 'num_linear_seqs': 0, 'bridging_mode': 'normal',
+                  'short_paired_libraries': ['short'], 'long_reads_library': 'long'}
+        bad_params = [('long_read_target_bases', 2000000000), ('target_depth', 255),
+                      ('zip_compresslevel', 10), ('output_tier', 'none'),
+                      ('quast_mode', 'fast'), ('max_depth', -5)]
+        # each is rejected before the workspace is asked about the libraries,
+        # and the console log is closed all the same
+        with mock.patch.object(impl, 'resolve_library_refs',
+                               side_effect=AssertionError('workspace called')), \
+                mock.patch.object(ConsoleLog, 'close', autospec=True,
+                                  side_effect=ConsoleLog.close) as close:
+            for name, value in bad_params:
+                with self.assertRaisesRegex(ValueError, name):
+                    impl.run_unicycler({}, dict(params, **{name: value}))
+        self.assertEqual(len(bad_params), close.call_count)
+
+    def test_log_process_output(self):
+        output = (b'tput: No value for $TERM\nA\r\nB\n\n' +
+                  b''.join(b'\r' + str(i).encode() + b'%' for i in range(50)) +
+                  b'\nC\n' + b''.join(str(i).encode() + b' / 9\n' for i in range(10)) +
+                  b'D\r\nE')
+        console = []
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.getImpl().log_process_output(console, io.BufferedReader(io.BytesIO(output)))
+        # progress bars redrawn after a carriage return, and N / M counters,
+        # are logged once, at their last frame
+        self.assertEqual(['A', 'B', '', '49%', 'C', '9 / 9', 'D', 'E'], console)
+
+    # add_deflated_member writes ZipFile's private state (_writecheck,
+    # _didModify, start_dir, fp, filelist, NameToInfo); this fails if that
+    # changes in the standard library
+    def test_add_deflated_member(self):
+        data = self.random_sequence(1000) * 300
+        path = self.write_file('member.gfa', data)
+        deflated_path = os.path.join(self.scratch, 'member.deflated')
+        [crc, file_size, compress_size] = deflate_zip_member(path, deflated_path, 6, 64 * 1024)
+        self.assertEqual(len(data), file_size)
+        self.assertEqual(os.path.getsize(deflated_path), compress_size)
+
+        output_path = os.path.join(self.scratch, 'add_deflated_member.zip')
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as ziph:
+            ziph.writestr('before.txt', b'before\n')
+            self.getImpl().add_deflated_member(ziph, path, 'out/member.gfa', deflated_path,
+                                               crc, file_size, compress_size)
+            ziph.writestr('after.txt', b'after\n')
+            self.assertIn('out/member.gfa', ziph.NameToInfo)
+        self.assertFalse(os.path.exists(deflated_path))
+        with zipfile.ZipFile(output_path) as ziph:
+            self.assertIsNone(ziph.testzip())
+            self.assertEqual(['before.txt', 'out/member.gfa', 'after.txt'], ziph.namelist())
+            self.assertEqual(data, ziph.read('out/member.gfa'))
+            self.assertEqual(compress_size, ziph.getinfo('out/member.gfa').compress_size)
+            self.assertEqual(b'after\n', ziph.read('after.txt'))
+
+
+if __name__ == '__main__':
+    unittest.main()